@@ -0,0 +1,174 @@
+"""
+Adaptive concurrency for the scripts that fan requests out over a thread
+pool.
+
+Instead of a fixed worker count, an `AdaptiveLimiter` decides how many tasks
+may run at once. It follows the additive-increase, multiplicative-decrease
+rule: every healthy response raises the limit by about one per round of
+requests, while a 429, a 5xx or a slowdown cuts it back. A run starts low
+and settles near the most concurrency the instance serves without
+throttling or slowing down.
+
+Slowdowns are judged per endpoint, as a search page and a changelog page
+take very different times. For each endpoint, the latency of the latest
+responses, smoothed over a few dozen of them so that ordinary jitter evens
+out, is compared with the lowest it has been in the last minute. A floor
+that expires lets the limiter follow an endpoint that has simply become
+slower, instead of measuring everything against one fast response.
+
+The limiter sees each response through a `requests` response hook:
+
+    limiter = AdaptiveLimiter(initial=10, max_limit=100)
+    requests.get(url, hooks={"response": limiter.observe})
+    with AdaptiveExecutor(limiter) as executor:
+        executor.map(fetch, urls)
+"""
+
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+# Fraction of the limit kept after a throttled, failed or slow response
+BACKOFF_FACTOR = 0.7
+# Recent responses this many times slower than the lowest recent latency of
+# the last LATENCY_WINDOW seconds count as congested
+LATENCY_TOLERANCE = 2.0
+LATENCY_WINDOW = 60.0
+# Weight of the latest response in the recent latency
+RECENT_SMOOTHING = 0.05
+# Responses of an endpoint averaged before its latency is judged at all
+WARMUP_RESPONSES = 20
+# Path segments with digits, such as issue keys and IDs, are one endpoint
+PATH_PARAMETER = re.compile(r"/[^/]*\d[^/]*")
+# The limit is cut at most once in this many seconds, so that a burst of
+# failures from one round of requests counts once
+DECREASE_COOLDOWN = 1.0
+
+
+def endpoint_of(response: requests.Response) -> str:
+    """The method and path of a response's request, with path parameters
+    left out."""
+    request = response.request
+    path = urlparse(request.url or "").path
+    return f"{request.method} {PATH_PARAMETER.sub('/{}', path)}"
+
+
+class EndpointLatency:
+    """The smoothed latency of one endpoint's recent responses, and the
+    lowest it has been within the last LATENCY_WINDOW seconds."""
+
+    def __init__(self) -> None:
+        self.responses = 0
+        self.recent = 0.0
+        # Lows of the recent latency and when they were seen, rising
+        self._lows: Deque[Tuple[float, float]] = deque()
+
+    def add(self, latency: float, now: float) -> None:
+        """Fold a response's latency in."""
+        self.responses += 1
+        # A plain average until the smoothing has enough responses to go on
+        weight = max(1 / self.responses, RECENT_SMOOTHING)
+        self.recent += weight * (latency - self.recent)
+        if self.responses < WARMUP_RESPONSES:
+            return
+        while self._lows and self._lows[-1][1] >= self.recent:
+            self._lows.pop()
+        self._lows.append((now, self.recent))
+        while self._lows[0][0] < now - LATENCY_WINDOW:
+            self._lows.popleft()
+
+    def congested(self) -> bool:
+        """Whether the recent latency is well above its lowest lately."""
+        return bool(self._lows) and (
+            self.recent > self._lows[0][1] * LATENCY_TOLERANCE
+        )
+
+    def settle(self) -> None:
+        """Forget the latency seen under a limit that has been cut."""
+        if self._lows:
+            self.recent = self._lows[0][1]
+
+
+class AdaptiveLimiter:
+    """An AIMD limit on the number of tasks running at once."""
+
+    def __init__(
+        self, initial: int = 4, min_limit: int = 1, max_limit: int = 64
+    ) -> None:
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._in_flight = 0
+        self._latency: Dict[str, EndpointLatency] = {}
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def __enter__(self) -> "AdaptiveLimiter":
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def observe(
+        self, response: requests.Response, *_args: Any, **_kwargs: Any
+    ) -> None:
+        """Response hook that adjusts the limit after every response."""
+        latency = response.elapsed.total_seconds()
+        endpoint = endpoint_of(response)
+        with self._condition:
+            endpoint_latency = self._latency.setdefault(endpoint, EndpointLatency())
+            endpoint_latency.add(latency, time.monotonic())
+
+            if response.status_code == 429 or response.status_code >= 500:
+                self._decrease(f"status {response.status_code}")
+            elif endpoint_latency.congested():
+                self._decrease(
+                    f"{endpoint} latency up to {endpoint_latency.recent:.2f}s"
+                )
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * BACKOFF_FACTOR)
+        for endpoint_latency in self._latency.values():
+            endpoint_latency.settle()
+        print(f"Concurrency cut to {int(self.limit)} ({reason})")
+
+    def report(self) -> None:
+        """Print the limit the run settled at."""
+        print(f"Concurrency settled at {int(self.limit)} of at most {self.max_limit}.")
+
+
+class AdaptiveExecutor(ThreadPoolExecutor):
+    """A thread pool that runs only as many tasks at once as its limiter
+    allows."""
+
+    def __init__(self, limiter: AdaptiveLimiter, **kwargs: Any) -> None:
+        super().__init__(max_workers=limiter.max_limit, **kwargs)
+        self.limiter = limiter
+
+    def submit(  # pylint: disable=arguments-differ
+        self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any
+    ) -> Future:
+        return super().submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+        with self.limiter:
+            return fn(*args, **kwargs)
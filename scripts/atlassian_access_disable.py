@@ -1,8 +1,20 @@
-""" This script will list all the audit actions for an organization. """
+"""
+This script removes the access of the Atlassian accounts listed in a CSV
+file.
+
+Before sending any requests it pulls the organisation's managed-user
+directory once and drops the rows that would be no-ops: duplicate rows,
+accounts the organisation does not manage, and accounts that are already
+closed. Run it with `--dry-run` to only print the plan.
+"""
+import argparse
 import os
 import csv
 import requests
 
+from directory_snapshot import fetch_directory, plan_changes, print_plan
+from retry_queue import RetryQueue
+
 
 # Load environment variables from the .env file if it exists
 def load_env_vars(env_path):
@@ -19,11 +31,20 @@ def load_env_vars(env_path):
 load_env_vars(os.path.join(os.path.dirname(__file__), ".env"))
 
 ACCESS_TOKEN = os.environ.get("ACCESS_TOKEN")
+ORG_ID = os.environ.get("ORG_ID")
+CSV_FILE = "accounts.csv"
+# Account statuses for which removing access would be a no-op; the lifecycle
+# delete closes the account
+NOOP_STATUSES = {"closed"}
+
+# Requests that fail are replayed once every account has been sent
+retry_queue = RetryQueue()
 
 
 def remove_user_access(account_id, access_token):
     """
-    Removes a user's access using the Atlassian API.
+    Removes a user's access using the Atlassian API, raising an error if the
+    request was not successful.
     """
     url = (
         f"https://api.atlassian.com/users/{account_id}/manage/lifecycle/"
@@ -34,28 +55,50 @@ def remove_user_access(account_id, access_token):
                "Content-Type": "application/json"}
 
     response = requests.post(url, headers=headers, timeout=30)
+    response.raise_for_status()
 
     return response.status_code, response.text
 
 
 def main():
     """
-    Main function that will read the CSV file and call the remove_user_access
-    function.
+    Main function that will read the CSV file, plan the changes against the
+    directory and call the remove_user_access function.
     """
-    with open("accounts.csv", "r", encoding="utf-8") as csv_file:
+    parser = argparse.ArgumentParser(description="Remove Atlassian access.")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only print the plan"
+    )
+    args = parser.parse_args()
+
+    with open(CSV_FILE, "r", encoding="utf-8") as csv_file:
         reader = csv.DictReader(csv_file)
-        for row in reader:
-            account_id = row["atlassian account id"]
-            status_code, response_text = remove_user_access(
-                account_id, ACCESS_TOKEN
-            )
+        account_ids = [row["atlassian account id"] for row in reader]
+
+    if ORG_ID:
+        directory = fetch_directory(ORG_ID, ACCESS_TOKEN)
+        account_ids, skipped = plan_changes(account_ids, directory, NOOP_STATUSES)
+        print_plan("remove access for", account_ids, skipped)
+    else:
+        print("ORG_ID is not set, so no-op rows cannot be filtered out.")
+
+    if args.dry_run:
+        return
 
+    for account_id in account_ids:
+        result = retry_queue.call(
+            f"access removal for {account_id}",
+            remove_user_access, account_id, ACCESS_TOKEN,
+        )
+        if result:
+            status_code, response_text = result
             # Print the status and response for each request
             print(
                 f"Account ID: {account_id}, Status Code: {status_code},"
                 f"Response: {response_text}"
             )
+    retry_queue.replay()
+    retry_queue.report()
 
 
 if __name__ == "__main__":
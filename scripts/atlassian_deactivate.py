@@ -8,31 +8,42 @@ variables from the file and stores them in the `os.environ` dictionary. The
 environment variables should contain the access token and organization ID
 required for authentication and API calls.
 
-The script defines two functions:
+The script defines three functions:
 
 1. `delete_atlassian_user(account_id)`:
    This function deletes an Atlassian user account with the given `account_id`
    from the specified organization. It makes a DELETE request to the Atlassian
-   API and prints a success or failure message based on the response.
+   API, prints a success or failure message based on the response and raises
+   an error if the request failed.
 
 2. `process_users_csv(file_path)`:
    This function reads user account IDs from the specified CSV file and calls
    the `delete_atlassian_user` function for each account ID. The CSV file
    should have a column named "atlassian account id" containing the account
-   IDs.
+   IDs. Before deleting anything it pulls the organisation's managed-user
+   directory once and drops the rows that would be no-ops (duplicate rows
+   and accounts that are not in the directory, including those already
+   removed from it), and prints a plan summary. Deletions that fail with a
+   transient error are retried once every account has been sent.
 
-Finally, the script calls the `process_users_csv` function with the path to
-the CSV file containing the user account IDs to be deleted.
+3. `main()`:
+   This function parses the command line and calls `process_users_csv`
+   with the path to the CSV file containing the user account IDs to be
+   deleted. With `--dry-run`, only the plan is printed.
 
 Note: Make sure to replace the placeholders for the access token and
 organization ID in the ".env" file with your actual values before running the
 script.
 """
 
+import argparse
 import csv
 import os
 import requests
 
+from directory_snapshot import fetch_directory, plan_changes, print_plan
+from retry_queue import RetryQueue
+
 # Check if the .env var exists and load the environment variables
 env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
 if os.path.exists(env_path):
@@ -45,6 +56,14 @@ if os.path.exists(env_path):
 access_token = os.environ.get("ACCESS_TOKEN")
 org_id = os.environ.get("ORG_ID")
 
+# Account statuses for which deactivation would be a no-op. The DELETE takes
+# the account out of the directory whatever its status, so an account that is
+# still listed always needs it; removed accounts are skipped as not managed
+NOOP_STATUSES = set()
+
+# Requests that fail are replayed once every account has been sent
+retry_queue = RetryQueue()
+
 
 def delete_atlassian_user(account_id):
     """
@@ -53,6 +72,9 @@ def delete_atlassian_user(account_id):
 
     Args:
         account_id (str): The ID of the Atlassian account to delete.
+
+    Raises:
+        requests.HTTPError: If the request was not successful.
     """
     url = f"https://api.atlassian.com/admin/v1/orgs/{org_id}/directory/" \
           f"users/{account_id}"
@@ -67,23 +89,51 @@ def delete_atlassian_user(account_id):
     else:
         print(f"Failed to delete user {account_id}. Status code: "
               f"{response.status_code}, Response: {response.text}")
+    response.raise_for_status()
 
 
-def process_users_csv(file_path):
+def process_users_csv(file_path, dry_run=False):
     """
     Reads user account IDs from the specified CSV file and calls the
-    `delete_atlassian_user` function for each account ID.
+    `delete_atlassian_user` function for each account ID that is not a no-op
+    according to the organisation's directory.
 
     Args:
         file_path (str): The path to the CSV file containing user account IDs.
+        dry_run (bool): Only print the plan, without deleting any users.
     """
     with open(file_path, newline='', encoding="utf-8") as csvfile:
         reader = csv.DictReader(csvfile)
-        for row in reader:
-            account_id = row['atlassian account id']
-            delete_atlassian_user(account_id)
+        account_ids = [row['atlassian account id'] for row in reader]
+
+    directory = fetch_directory(org_id, access_token)
+    account_ids, skipped = plan_changes(account_ids, directory, NOOP_STATUSES)
+    print_plan("deactivate", account_ids, skipped)
+
+    if dry_run:
+        return
+    for account_id in account_ids:
+        retry_queue.call(f"deletion of {account_id}", delete_atlassian_user,
+                         account_id)
+    retry_queue.replay()
+    retry_queue.report()
 
 
 # Specify the path to your CSV file
 CSV_FILE_PATH = 'accounts.csv'
-process_users_csv(CSV_FILE_PATH)
+
+
+def main():
+    """
+    Parses the command line and processes the CSV file.
+    """
+    parser = argparse.ArgumentParser(description="Deactivate Atlassian users.")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only print the plan"
+    )
+    args = parser.parse_args()
+    process_users_csv(CSV_FILE_PATH, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
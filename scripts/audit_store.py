@@ -0,0 +1,409 @@
+"""
+This script keeps a local, indexed SQLite copy of the data exported by
+`jira_edit_audit.py`, `jira_service_management_audit.py` and
+`license_export.py`, so that repeated questions can be answered without
+calling the Atlassian APIs again.
+
+Two kinds of command are available:
+
+1. `ingest`: Upserts the exported CSV files into the database. Audit events
+   are keyed on event ID and issue, changelog entries on issue key and
+   history ID, and licences on account, site and product. Re-ingesting the
+   same export only refreshes the existing rows. Audit events keep the
+   issue key, project and summary that `jira_edit_audit.py` resolved for
+   them, so `events --issue` finds events logged under a numeric issue ID
+   by their key too.
+2. `events`, `changelog`, `licences` and `sql`: Query the database and
+   print the matching rows as CSV on stdout.
+
+Examples:
+    python audit_store.py ingest
+    python audit_store.py events --issue PROJ-123 --since 2024-05-01
+    python audit_store.py licences --billable --inactive-days 90
+"""
+
+import argparse
+import csv
+import hashlib
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Check if the .env var exists and load the environment variables
+env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
+if os.path.exists(env_path):
+    with open(env_path, encoding="utf-8") as file:
+        for line in file:
+            key, value = line.strip().split("=", 1)
+            os.environ[key] = value
+
+DB_PATH = os.environ.get("AUDIT_DB_PATH", "audit_store.db")
+AUDIT_CSV = "audit_logs.csv"
+CHANGELOG_CSV = "changelog.csv"
+LICENCES_CSV = "managed_accounts.csv"
+BATCH_SIZE = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS audit_events (
+    event_id TEXT NOT NULL,
+    issue_key TEXT NOT NULL,
+    time TEXT,
+    action TEXT,
+    actor_name TEXT,
+    actor_email TEXT,
+    resolved_issue_key TEXT,
+    project TEXT,
+    summary TEXT,
+    PRIMARY KEY (event_id, issue_key)
+);
+CREATE INDEX IF NOT EXISTS idx_audit_events_actor
+    ON audit_events (actor_email, time);
+CREATE INDEX IF NOT EXISTS idx_audit_events_issue
+    ON audit_events (issue_key, time);
+CREATE INDEX IF NOT EXISTS idx_audit_events_time ON audit_events (time);
+
+CREATE TABLE IF NOT EXISTS changelog (
+    issue_key TEXT NOT NULL,
+    history_id TEXT NOT NULL,
+    actor TEXT,
+    created TEXT,
+    PRIMARY KEY (issue_key, history_id)
+);
+CREATE INDEX IF NOT EXISTS idx_changelog_actor ON changelog (actor, created);
+CREATE INDEX IF NOT EXISTS idx_changelog_created ON changelog (created);
+
+CREATE TABLE IF NOT EXISTS licences (
+    account_id TEXT NOT NULL,
+    product_url TEXT NOT NULL,
+    product_key TEXT NOT NULL,
+    account_type TEXT,
+    account_status TEXT,
+    name TEXT,
+    email TEXT,
+    access_billable INTEGER,
+    last_active TEXT,
+    product_name TEXT,
+    product_last_active TEXT,
+    PRIMARY KEY (account_id, product_url, product_key)
+);
+CREATE INDEX IF NOT EXISTS idx_licences_email ON licences (email);
+CREATE INDEX IF NOT EXISTS idx_licences_product_last_active
+    ON licences (product_key, product_last_active);
+"""
+
+# Columns added to audit_events after it was first created
+AUDIT_RESOLVED_COLUMNS = ["resolved_issue_key", "project", "summary"]
+AUDIT_RESOLVED_INDEX = """
+CREATE INDEX IF NOT EXISTS idx_audit_events_resolved_issue
+    ON audit_events (resolved_issue_key, time)
+"""
+
+AUDIT_UPSERT = """
+INSERT INTO audit_events
+    (event_id, issue_key, time, action, actor_name, actor_email,
+     resolved_issue_key, project, summary)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (event_id, issue_key) DO UPDATE SET
+    time = excluded.time,
+    action = excluded.action,
+    actor_name = excluded.actor_name,
+    actor_email = excluded.actor_email,
+    resolved_issue_key = COALESCE(
+        excluded.resolved_issue_key, audit_events.resolved_issue_key
+    ),
+    project = COALESCE(excluded.project, audit_events.project),
+    summary = COALESCE(excluded.summary, audit_events.summary)
+"""
+
+CHANGELOG_UPSERT = """
+INSERT INTO changelog (issue_key, history_id, actor, created)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (issue_key, history_id) DO UPDATE SET
+    actor = excluded.actor,
+    created = excluded.created
+"""
+
+LICENCES_UPSERT = """
+INSERT INTO licences
+    (account_id, product_url, product_key, account_type, account_status,
+     name, email, access_billable, last_active, product_name,
+     product_last_active)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (account_id, product_url, product_key) DO UPDATE SET
+    account_type = excluded.account_type,
+    account_status = excluded.account_status,
+    name = excluded.name,
+    email = excluded.email,
+    access_billable = excluded.access_billable,
+    last_active = excluded.last_active,
+    product_name = excluded.product_name,
+    product_last_active = excluded.product_last_active
+"""
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Open the database and make sure the schema exists."""
+    connection = sqlite3.connect(db_path)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executescript(SCHEMA)
+    # Databases created before issues were resolved lack their columns
+    existing = {
+        column[1] for column in connection.execute("PRAGMA table_info(audit_events)")
+    }
+    with connection:
+        for column in AUDIT_RESOLVED_COLUMNS:
+            if column not in existing:
+                connection.execute(f"ALTER TABLE audit_events ADD COLUMN {column} TEXT")
+        connection.execute(AUDIT_RESOLVED_INDEX)
+    return connection
+
+
+def row_digest(*values: str) -> str:
+    """Build a stable surrogate key for rows exported without an ID column."""
+    return hashlib.sha1("\x1f".join(values).encode("utf-8")).hexdigest()
+
+
+def read_csv_rows(file_path: str) -> Iterator[Dict[str, str]]:
+    """Yield the rows of a CSV file as dictionaries."""
+    with open(file_path, newline="", encoding="utf-8") as csv_file:
+        yield from csv.DictReader(csv_file)
+
+
+def audit_records(rows: Iterable[Dict[str, str]]) -> Iterator[Tuple]:
+    """Convert `audit_logs.csv` rows into `audit_events` records.
+
+    Exports without resolved issues, or rows whose issue could not be
+    resolved, leave the resolved columns as they were.
+    """
+    for row in rows:
+        event_id = row.get("Event ID") or row_digest(
+            row["Time"], row["Action"], row["Actor Email"], row["Issue Key"]
+        )
+        yield (
+            event_id,
+            row["Issue Key"],
+            row["Time"],
+            row["Action"],
+            row["Actor Name"],
+            row["Actor Email"],
+            row.get("Resolved Issue Key") or None,
+            row.get("Project") or None,
+            row.get("Summary") or None,
+        )
+
+
+def changelog_records(rows: Iterable[Dict[str, str]]) -> Iterator[Tuple]:
+    """Convert `changelog.csv` rows into `changelog` records."""
+    for row in rows:
+        history_id = row.get("History ID") or row_digest(
+            row["Actor"], row["Issue"], row["Date"]
+        )
+        yield (row["Issue"], history_id, row["Actor"], row["Date"])
+
+
+def licence_records(rows: Iterable[Dict[str, str]]) -> Iterator[Tuple]:
+    """Convert `managed_accounts.csv` rows into `licences` records."""
+    for row in rows:
+        yield (
+            row["account_id"],
+            row["product_url"],
+            row["product_access_key"],
+            row["account_type"],
+            row["account_status"],
+            row["name"],
+            row["email"],
+            1 if row["access_billable"] == "True" else 0,
+            row["last_active"],
+            row["product_access_name"],
+            row["product_access_last_active"],
+        )
+
+
+def upsert(
+    connection: sqlite3.Connection, statement: str, records: Iterable[Tuple]
+) -> int:
+    """Upsert records in batches inside a single transaction."""
+    count = 0
+    batch: List[Tuple] = []
+    with connection:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                connection.executemany(statement, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            connection.executemany(statement, batch)
+            count += len(batch)
+    return count
+
+
+def ingest(connection: sqlite3.Connection, args: argparse.Namespace) -> None:
+    """Upsert every export file that was given or exists with its default
+    name."""
+    sources = [
+        (args.audit, AUDIT_CSV, AUDIT_UPSERT, audit_records),
+        (args.changelog, CHANGELOG_CSV, CHANGELOG_UPSERT, changelog_records),
+        (args.licences, LICENCES_CSV, LICENCES_UPSERT, licence_records),
+    ]
+    explicit = any(source[0] for source in sources)
+    for given_path, default_path, statement, to_records in sources:
+        file_path = given_path or (None if explicit else default_path)
+        if not file_path or not os.path.exists(file_path):
+            continue
+        count = upsert(connection, statement, to_records(read_csv_rows(file_path)))
+        print(f"Upserted {count} rows from {file_path}", file=sys.stderr)
+
+
+def build_filters(
+    conditions: Sequence[Tuple[str, Optional[str]]]
+) -> Tuple[str, List[str]]:
+    """Build a WHERE clause from (condition, value) pairs with a value set.
+    The value is bound to every placeholder of its condition."""
+    clauses = [condition for condition, value in conditions if value]
+    params = [
+        value
+        for condition, value in conditions
+        if value
+        for _ in range(condition.count("?"))
+    ]
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+
+def query_events(connection: sqlite3.Connection, args: argparse.Namespace):
+    """Query audit events by actor, issue, action and time."""
+    where, params = build_filters(
+        [
+            ("actor_email = ?", args.actor),
+            ("(issue_key = ? OR resolved_issue_key = ?)", args.issue),
+            ("action = ?", args.action),
+            ("time >= ?", args.since),
+            ("time < ?", args.until),
+        ]
+    )
+    return connection.execute(
+        "SELECT time, action, actor_name, actor_email, issue_key, event_id, "
+        "resolved_issue_key, project, summary "
+        f"FROM audit_events{where} ORDER BY time",
+        params,
+    )
+
+
+def query_changelog(connection: sqlite3.Connection, args: argparse.Namespace):
+    """Query changelog entries by actor, issue and time."""
+    where, params = build_filters(
+        [
+            ("actor = ?", args.actor),
+            ("issue_key = ?", args.issue),
+            ("created >= ?", args.since),
+            ("created < ?", args.until),
+        ]
+    )
+    return connection.execute(
+        "SELECT actor, issue_key, created, history_id "
+        f"FROM changelog{where} ORDER BY issue_key, created",
+        params,
+    )
+
+
+def query_licences(connection: sqlite3.Connection, args: argparse.Namespace):
+    """Query licences, optionally only billable or inactive ones."""
+    cutoff = None
+    if args.inactive_days is not None:
+        cutoff = (datetime.utcnow() - timedelta(days=args.inactive_days)).strftime(
+            "%Y-%m-%dT%H:%M:%S"
+        )
+    where, params = build_filters(
+        [
+            ("product_key = ?", args.product_key),
+            ("product_url = ?", args.site),
+            ("(product_last_active = '' OR product_last_active < ?)", cutoff),
+        ]
+    )
+    if args.billable:
+        where += " AND access_billable = 1" if where else " WHERE access_billable = 1"
+    return connection.execute(
+        "SELECT account_id, name, email, product_url, product_key, "
+        "access_billable, product_last_active "
+        f"FROM licences{where} ORDER BY email, product_key",
+        params,
+    )
+
+
+def query_sql(connection: sqlite3.Connection, args: argparse.Namespace):
+    """Run an arbitrary SQL statement against the store."""
+    return connection.execute(args.statement)
+
+
+def print_cursor(cursor: sqlite3.Cursor) -> None:
+    """Write the rows of a cursor as CSV to stdout, with a header row."""
+    writer = csv.writer(sys.stdout)
+    if cursor.description:
+        writer.writerow([column[0] for column in cursor.description])
+    writer.writerows(cursor)
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--db", default=DB_PATH, help="SQLite database path")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = commands.add_parser("ingest", help="upsert exported CSVs")
+    ingest_parser.add_argument("--audit", help=f"defaults to {AUDIT_CSV}")
+    ingest_parser.add_argument("--changelog", help=f"defaults to {CHANGELOG_CSV}")
+    ingest_parser.add_argument("--licences", help=f"defaults to {LICENCES_CSV}")
+    ingest_parser.set_defaults(handler=ingest)
+
+    events_parser = commands.add_parser("events", help="query audit events")
+    events_parser.add_argument("--actor", help="actor email address")
+    events_parser.add_argument(
+        "--issue", help="issue key or ID, as logged or as resolved"
+    )
+    events_parser.add_argument("--action", help="e.g. jira_issue_viewed")
+    events_parser.add_argument("--since", help="inclusive ISO date/time")
+    events_parser.add_argument("--until", help="exclusive ISO date/time")
+    events_parser.set_defaults(handler=query_events)
+
+    changelog_parser = commands.add_parser("changelog", help="query changelogs")
+    changelog_parser.add_argument("--actor", help="actor email address")
+    changelog_parser.add_argument("--issue", help="issue key")
+    changelog_parser.add_argument("--since", help="inclusive ISO date/time")
+    changelog_parser.add_argument("--until", help="exclusive ISO date/time")
+    changelog_parser.set_defaults(handler=query_changelog)
+
+    licences_parser = commands.add_parser("licences", help="query licences")
+    licences_parser.add_argument("--billable", action="store_true")
+    licences_parser.add_argument(
+        "--inactive-days",
+        type=int,
+        help="only product access not used for this many days",
+    )
+    licences_parser.add_argument("--product-key", help="e.g. jira-software")
+    licences_parser.add_argument("--site", help="product URL without https://")
+    licences_parser.set_defaults(handler=query_licences)
+
+    sql_parser = commands.add_parser("sql", help="run a raw SQL statement")
+    sql_parser.add_argument("statement")
+    sql_parser.set_defaults(handler=query_sql)
+
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Main function that dispatches to the requested command."""
+    args = parse_args(argv)
+    connection = connect(args.db)
+    try:
+        cursor = args.handler(connection, args)
+        if cursor is not None:
+            print_cursor(cursor)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
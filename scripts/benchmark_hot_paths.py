@@ -0,0 +1,298 @@
+"""
+CPU micro-benchmarks for the per-row transform and write paths.
+
+The hot loops of the exporters are driven with synthetic payloads, without
+any network access:
+
+- `license_process_account`: `license_export.process_account`.
+- `license_add_row_to_queue`: `license_export.add_row_to_queue` on its own.
+- `audit_write_rows`: the container-flattening loop that writes
+  `audit_logs.csv` in `jira_edit_audit.py`.
+- `changelog_build_rows`: changelog row building in
+  `jira_service_management_audit.py`.
+
+The licence cases empty their queue between calls, outside the timing,
+rather than racing a writer thread whose scheduling would change the time
+per row from one run to the next.
+
+Each case reports the time per output row and the peak memory traced by
+`tracemalloc` during the run (the number of allocations is not measured),
+and compares the time with the stored baseline in `benchmark_baseline.json`.
+The baseline holds absolute timings from one machine, and only for the
+default sizes, so a CI job should record its own with `--save-baseline` on
+the base branch, in the same job, before comparing a change against it.
+
+Examples:
+    python benchmark_hot_paths.py
+    python benchmark_hot_paths.py --sizes 10000 100000 1000000
+    python benchmark_hot_paths.py --save-baseline
+"""
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import sys
+import time
+import tracemalloc
+from queue import Queue
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# The scripts read their settings at import time; keep them offline
+os.environ.setdefault("JIRA_URL", "https://example.atlassian.net")
+
+import jira_edit_audit  # noqa: E402 pylint: disable=wrong-import-position
+import jira_service_management_audit  # noqa: E402 pylint: disable=wrong-import-position
+import license_export  # noqa: E402 pylint: disable=wrong-import-position
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+# Sizes with a stored baseline; pass larger ones with --sizes
+DEFAULT_SIZES = [10_000, 100_000]
+# A case is reported as a regression when it is this much slower
+REGRESSION_THRESHOLD = 1.5
+SITE = "example.atlassian.net"
+HISTORIES_PER_ISSUE = 20
+CONTAINERS_PER_EVENT = 2
+
+# A case yields (function, args, rows produced) for each call to time
+Case = Callable[[int], Iterator[Tuple[Callable[..., Any], tuple, int]]]
+
+
+def synthetic_account(index: int) -> Dict[str, Any]:
+    """An org user with one product on the exported site and one elsewhere."""
+    return {
+        "account_id": f"account-{index}",
+        "account_type": "atlassian",
+        "account_status": "active",
+        "name": f"User Námé {index}",
+        "email": f"user{index}@example.com",
+        "access_billable": True,
+        "last_active": "2024-05-01T10:00:00.000Z",
+        "product_access": [
+            {
+                "key": "jira-software",
+                "name": "Jira Software",
+                "url": SITE,
+                "last_active": "2024-05-01T10:00:00.000Z",
+            },
+            {
+                "key": "confluence",
+                "name": "Confluence",
+                "url": "other.atlassian.net",
+                "last_active": "2024-04-01T10:00:00.000Z",
+            },
+        ],
+    }
+
+
+def synthetic_row(index: int) -> Dict[str, Any]:
+    """A managed account CSV row as built by `process_account`."""
+    return {
+        "account_id": f"account-{index}",
+        "account_type": "atlassian",
+        "account_status": "active",
+        "name": f"User Name {index}",
+        "email": f"user{index}@example.com",
+        "access_billable": True,
+        "last_active": "2024-05-01T10:00:00.000Z",
+        "product_access_key": "jira-software",
+        "product_access_name": "Jira Software",
+        "product_url": SITE,
+        "product_access_last_active": "2024-05-01T10:00:00.000Z",
+    }
+
+
+def synthetic_event(index: int) -> Dict[str, Any]:
+    """An organisation audit event touching several issues."""
+    return {
+        "id": f"event-{index}",
+        "attributes": {
+            "time": "2024-05-01T10:00:00.000Z",
+            "action": "jira_issue_viewed",
+            "actor": {"name": f"User {index}", "email": f"user{index}@example.com"},
+            "container": [
+                {"attributes": {"issueKeyOrId": str(10_000 + index + offset)}}
+                for offset in range(CONTAINERS_PER_EVENT)
+            ],
+        },
+    }
+
+
+def synthetic_histories(issue_index: int) -> List[Dict[str, Any]]:
+    """The changelog histories of one issue."""
+    return [
+        {
+            "id": str(issue_index * HISTORIES_PER_ISSUE + offset),
+            "created": "2024-05-01T10:00:00.000+0000",
+            "author": {"emailAddress": f"user{offset}@example.com"},
+        }
+        for offset in range(HISTORIES_PER_ISSUE)
+    ]
+
+
+def case_license_process_account(rows: int):
+    """Process one account per output row."""
+    seen_combinations: set = set()
+    queue: Queue = Queue()
+    for index in range(rows):
+        yield (
+            license_export.process_account,
+            (synthetic_account(index), queue, seen_combinations, {SITE}),
+            1,
+        )
+        queue.queue.clear()
+
+
+def case_license_add_row_to_queue(rows: int):
+    """Queue one row per call."""
+    queue: Queue = Queue()
+    for index in range(rows):
+        yield license_export.add_row_to_queue, (queue, synthetic_row(index)), 1
+        queue.queue.clear()
+
+
+def case_audit_write_rows(rows: int):
+    """Flatten one event into CONTAINERS_PER_EVENT rows per call."""
+    with open(os.devnull, "w", newline="", encoding="utf-8") as devnull:
+        writer = csv.writer(devnull)
+        for index in range(rows // CONTAINERS_PER_EVENT):
+            yield (
+                jira_edit_audit.write_audit_rows,
+                (writer, [synthetic_event(index)]),
+                CONTAINERS_PER_EVENT,
+            )
+
+
+def case_changelog_build_rows(rows: int):
+    """Build HISTORIES_PER_ISSUE rows per call."""
+    for index in range(rows // HISTORIES_PER_ISSUE):
+        yield (
+            jira_service_management_audit.build_changelog_rows,
+            (f"SD-{index}", synthetic_histories(index)),
+            HISTORIES_PER_ISSUE,
+        )
+
+
+CASES: Dict[str, Case] = {
+    "license_process_account": case_license_process_account,
+    "license_add_row_to_queue": case_license_add_row_to_queue,
+    "audit_write_rows": case_audit_write_rows,
+    "changelog_build_rows": case_changelog_build_rows,
+}
+
+
+def run_case(case: Case, rows: int, trace_memory: bool) -> Tuple[float, int, int]:
+    """Run a case and return the seconds spent in the measured calls, the
+    rows produced and the peak traced memory in bytes.
+
+    Building the synthetic payloads is excluded from the timing.
+    """
+    elapsed = 0.0
+    produced = 0
+    if trace_memory:
+        tracemalloc.start()
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        # The exporters log every row; keep that cost but not the output
+        with contextlib.redirect_stdout(devnull):
+            for function, args, row_count in case(rows):
+                started = time.perf_counter()
+                function(*args)
+                elapsed += time.perf_counter() - started
+                produced += row_count
+    peak = 0
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, produced, peak
+
+
+def load_baseline() -> Dict[str, Dict[str, float]]:
+    """Load the stored per-row timings, keyed by case and size."""
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE, encoding="utf-8") as baseline_file:
+        return json.load(baseline_file)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description="Benchmark the hot loops.")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="rows per case"
+    )
+    parser.add_argument(
+        "--cases", nargs="+", choices=sorted(CASES), default=sorted(CASES)
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="timed runs per case and size; the fastest is kept",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help=f"store the timings in {os.path.basename(BASELINE_FILE)}",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="skip the separate memory-tracing run",
+    )
+    return parser.parse_args(argv)
+
+
+def measure(case: Case, size: int, args: argparse.Namespace) -> Tuple[float, str]:
+    """Return the fastest time per row in microseconds and the formatted
+    peak traced memory of a case."""
+    elapsed, produced, _ = min(
+        run_case(case, size, trace_memory=False) for _ in range(args.repeat)
+    )
+    peak = "-"
+    if not args.no_memory:
+        # Traced separately, as tracing slows the timed run down
+        peak = f"{run_case(case, size, trace_memory=True)[2] / 1024:.0f}"
+    return elapsed / produced * 1e6, peak
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the benchmarks; returns 1 if any case regressed."""
+    args = parse_args(argv)
+    baseline = load_baseline()
+    results: Dict[str, Dict[str, float]] = {}
+    regressions = 0
+
+    print(
+        f"{'case':<26}{'rows':>9}{'us/row':>10}{'peak KiB':>10}"
+        f"{'vs baseline':>16}"
+    )
+    for name in args.cases:
+        for size in args.sizes:
+            per_row_us, peak = measure(CASES[name], size, args)
+            results.setdefault(name, {})[str(size)] = round(per_row_us, 4)
+
+            expected = baseline.get(name, {}).get(str(size))
+            comparison = "-"
+            if expected:
+                ratio = per_row_us / expected
+                comparison = f"{ratio:.2f}x"
+                if ratio > REGRESSION_THRESHOLD:
+                    comparison += " SLOWER"
+                    regressions += 1
+            print(
+                f"{name:<26}{size:>9}{per_row_us:>10.3f}{peak:>10}{comparison:>16}"
+            )
+
+    if args.save_baseline:
+        for name, timings in results.items():
+            baseline.setdefault(name, {}).update(timings)
+        with open(BASELINE_FILE, "w", encoding="utf-8") as baseline_file:
+            json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"Baseline saved to {BASELINE_FILE}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Snapshot of an organisation's managed-user directory.
+
+The `/orgs/{id}/users` listing is paged through once and kept in memory by
+account ID, so that the scripts that change accounts can drop rows that
+would be no-ops (accounts that are not managed by the organisation, or that
+are already in the target state) before sending any requests.
+"""
+
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+import json_backend
+
+ORG_USERS_URL = "https://api.atlassian.com/admin/v1/orgs/{org_id}/users"
+# Fields kept for each account; product access is not needed for planning
+SNAPSHOT_FIELDS = ("account_id", "account_type", "account_status", "name", "email")
+
+
+def fetch_directory(org_id: str, access_token: str) -> Dict[str, Dict[str, Any]]:
+    """Page through the organisation's managed users and return them keyed
+    by account ID."""
+    url = ORG_USERS_URL.format(org_id=org_id)
+    headers = {
+        "Accept": "application/json",
+        "Authorization": f"Bearer {access_token}",
+    }
+    directory: Dict[str, Dict[str, Any]] = {}
+    cursor: Optional[str] = None
+    page_count = 1
+    while True:
+        print(f"Fetching directory page {page_count}...")
+        params = {"cursor": cursor} if cursor else None
+        response = requests.get(
+            url, headers=headers, params=params, timeout=30, stream=True
+        )
+        response.raise_for_status()
+        page_envelope: Dict[str, Any] = {}
+        for account in json_backend.iter_array(response, "data", page_envelope):
+            directory[account["account_id"]] = {
+                field: account.get(field, "") for field in SNAPSHOT_FIELDS
+            }
+
+        next_url = page_envelope.get("links", {}).get("next")
+        if not next_url:
+            break
+        cursor = parse_qs(urlparse(next_url).query)["cursor"][0]
+        page_count += 1
+
+    print(f"Loaded {len(directory)} managed accounts.")
+    return directory
+
+
+def plan_changes(
+    account_ids: Iterable[str],
+    directory: Dict[str, Dict[str, Any]],
+    noop_statuses: Set[str],
+) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """Split the requested account IDs into the ones that need a change and
+    the ones that would be no-ops.
+
+    Returns the account IDs to change, in input order, and (account ID,
+    reason) pairs for the skipped ones.
+    """
+    to_change: List[str] = []
+    skipped: List[Tuple[str, str]] = []
+    seen: Set[str] = set()
+    for account_id in account_ids:
+        if account_id in seen:
+            skipped.append((account_id, "duplicate row"))
+            continue
+        seen.add(account_id)
+
+        account = directory.get(account_id)
+        if account is None:
+            skipped.append((account_id, "not managed by the organisation"))
+        elif account["account_status"] in noop_statuses:
+            skipped.append((account_id, f"already {account['account_status']}"))
+        else:
+            to_change.append(account_id)
+    return to_change, skipped
+
+
+def print_plan(
+    action: str, to_change: List[str], skipped: List[Tuple[str, str]]
+) -> None:
+    """Print a summary of the planned changes and the skipped no-ops."""
+    print(f"Plan: {action} {len(to_change)} accounts, skip {len(skipped)}.")
+    for reason, count in Counter(reason for _, reason in skipped).most_common():
+        print(f"  Skipping {count}: {reason}")
@@ -1,10 +1,34 @@
-"""Module to export users from a specified Jira group to a CSV file."""
+"""Module to export users from a specified Jira group to a CSV file.
+
+`/group/member` omits `emailAddress` for users who hide it. Those emails are
+filled in afterwards in batches, first through the bulk user endpoint and
+then, when `ORG_ID` and `ACCESS_TOKEN` are set, by joining against the
+organisation's managed-user listing. Resolved emails are cached in
+`user_profile_cache.json` so later exports do not look them up again.
+
+Several groups can be exported in one run with `--groups NAME ...`,
+`--groups-file FILE` (one group name per line) or `--pattern GLOB`, which is
+matched against every group on the site. The groups are paged concurrently
+over one connection pool and each user is stored once: the users go to
+`jira_users_from_groups.csv` and the memberships, one row per group and
+user, to `jira_group_memberships.csv`.
+"""
+import argparse
 import csv
+import fnmatch
+import json
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
+import json_backend
+from directory_snapshot import fetch_directory
+from retry_queue import RetryQueue
+
 # Check if the .env var exists and load the environment variables
 env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
 if os.path.exists(env_path):
@@ -18,66 +42,337 @@ JIRA_URL = os.environ.get("JIRA_URL")
 USER_EMAIL = os.environ.get("USER_EMAIL")
 API_TOKEN = os.environ.get("API_TOKEN")
 EXPORT_GROUP_NAME = os.environ.get("EXPORT_GROUP_NAME")
+ORG_ID = os.environ.get("ORG_ID")
+ACCESS_TOKEN = os.environ.get("ACCESS_TOKEN")
+OUTPUT_FILE = "jira_users_from_group.csv"
+USERS_OUTPUT_FILE = "jira_users_from_groups.csv"
+MEMBERSHIP_OUTPUT_FILE = "jira_group_memberships.csv"
+# Largest page size the group member endpoint accepts
+PAGE_SIZE = 50
+# Account IDs resolved per bulk user request
+BULK_BATCH_SIZE = 100
+MAX_WORKERS = 5
+# Groups paged at once in the multi-group mode
+GROUP_WORKERS = 10
+PROFILE_CACHE_FILE = os.environ.get(
+    "PROFILE_CACHE_FILE", "user_profile_cache.json"
+)
+# Cached emails, and the fact that an email is hidden, expire after this
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_DAYS", "7")) * 86400
 
 auth = HTTPBasicAuth(USER_EMAIL, API_TOKEN)
 headers = {"Accept": "application/json"}
 
-# Get all users from the group
 url = f"{JIRA_URL}/rest/api/3/group/member"
-query = {"groupname": EXPORT_GROUP_NAME, "startAt": 0, "maxResults": 50}
+bulk_url = f"{JIRA_URL}/rest/api/3/user/bulk"
+groups_url = f"{JIRA_URL}/rest/api/3/group/bulk"
 
-response = requests.get(
-    url, headers=headers, params=query, auth=auth, timeout=30
-)
+# Group pages and bulk lookups that fail are replayed once every batch has been sent
+retry_queue = RetryQueue()
+
+
+def fetch_group_members(group_name, session=requests):
+    """Fetch every member of a group, following the pagination."""
+    query = {"groupname": group_name, "startAt": 0, "maxResults": PAGE_SIZE}
+    all_users = []
+    while True:
+        response = session.get(
+            url, headers=headers, params=query, auth=auth, timeout=30
+        )
+        response.raise_for_status()
+        group_data = json_backend.decode(response)
+        all_users.extend(group_data.get("values", []))
+        if group_data.get("isLast", True):
+            return all_users
+        query["startAt"] += query["maxResults"]
+
+
+def list_groups(session=requests):
+    """Return the names of every group on the site."""
+    query = {"startAt": 0, "maxResults": PAGE_SIZE}
+    names = []
+    while True:
+        response = session.get(
+            groups_url, headers=headers, params=query, auth=auth, timeout=30
+        )
+        response.raise_for_status()
+        page = json_backend.decode(response)
+        names.extend(group["name"] for group in page.get("values", []))
+        if page.get("isLast", True):
+            return names
+        query["startAt"] += query["maxResults"]
+
+
+def select_groups(args, session=requests):
+    """Return the group names requested on the command line, in order and
+    without duplicates."""
+    names = list(args.groups or [])
+    if args.groups_file:
+        with open(args.groups_file, encoding="utf-8") as groups_file:
+            names.extend(line.strip() for line in groups_file if line.strip())
+    if args.pattern:
+        names.extend(
+            name for name in list_groups(session)
+            if fnmatch.fnmatchcase(name.lower(), args.pattern.lower())
+        )
+    return list(dict.fromkeys(names))
+
+
+def fetch_memberships(group_names):
+    """Page the members of several groups concurrently over one connection
+    pool.
+
+    Returns the users keyed by account ID, each stored once, and the
+    (group name, account ID) membership pairs.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GROUP_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    def fetch(group_name):
+        return group_name, fetch_group_members(group_name, session)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=GROUP_WORKERS) as executor:
+        results.extend(
+            result for result in executor.map(
+                lambda group_name: retry_queue.call(
+                    f"members of group {group_name}", fetch, group_name
+                ),
+                group_names,
+            )
+            if result
+        )
+    results.extend(result for _, result in retry_queue.replay())
+
+    users = {}
+    memberships = []
+    for group_name, members in results:
+        print(f"Group {group_name} has {len(members)} members.")
+        for user in members:
+            users.setdefault(user["accountId"], user)
+            memberships.append((group_name, user["accountId"]))
+    memberships.sort()
+    return users, memberships
+
+
+def write_memberships_csv(memberships, output_file):
+    """Write one row per group and member."""
+    with open(output_file, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Group Name", "Account ID"])
+        writer.writerows(memberships)
+
+
+def export_groups(group_names):
+    """Export the members of several groups to a deduplicated user table
+    and a membership table."""
+    print(f"Exporting the members of {len(group_names)} groups...")
+    users, memberships = fetch_memberships(group_names)
+    print(
+        f"Found {len(memberships)} memberships of {len(users)} distinct users."
+    )
+    enrich_emails(list(users.values()))
+    write_users_csv(list(users.values()), USERS_OUTPUT_FILE)
+    write_memberships_csv(memberships, MEMBERSHIP_OUTPUT_FILE)
+    print(f"Memberships have been written to {MEMBERSHIP_OUTPUT_FILE}")
 
-# Check the HTTP status code
-if response.status_code != 200:
-    print(f"Failed to fetch data. HTTP Status Code: {response.status_code}")
-    print(response.text)
-    sys.exit()
 
-# Parse the response as JSON
-group_data = response.json()
+def load_profile_cache():
+    """Load the cached emails that have not expired, keyed by account ID."""
+    if not os.path.exists(PROFILE_CACHE_FILE):
+        return {}
+    with open(PROFILE_CACHE_FILE, encoding="utf-8") as cache_file:
+        cache = json.load(cache_file)
+    oldest = time.time() - PROFILE_CACHE_TTL
+    return {
+        account_id: entry
+        for account_id, entry in cache.items()
+        if entry["resolved_at"] >= oldest
+    }
 
-users = group_data.get("values", [])
 
-# If users are empty, exit early
-if not users:
-    print("No users found for the provided group.")
-    sys.exit()
+def save_profile_cache(cache):
+    """Write the email cache back to disk."""
+    with open(PROFILE_CACHE_FILE, "w", encoding="utf-8") as cache_file:
+        json.dump(cache, cache_file)
 
-# If there are more pages, handle pagination
-all_users = users
-while group_data.get("isLast", False) is False:
-    query["startAt"] += query["maxResults"]
-    response = requests.get(
-        url, headers=headers, params=query, auth=auth, timeout=30
+
+def fetch_user_batch(account_ids):
+    """Resolve a batch of account IDs through the bulk user endpoint and
+    return their emails, keyed by account ID, with None for hidden ones."""
+    emails = dict.fromkeys(account_ids)
+    start_at = 0
+    while True:
+        response = requests.get(
+            bulk_url,
+            headers=headers,
+            params={
+                "accountId": account_ids,
+                "startAt": start_at,
+                "maxResults": len(account_ids),
+            },
+            auth=auth,
+            timeout=30,
+        )
+        response.raise_for_status()
+        page = json_backend.decode(response)
+        for user in page.get("values", []):
+            if user.get("emailAddress"):
+                emails[user["accountId"]] = user["emailAddress"]
+        start_at += len(page.get("values", []))
+        if page.get("isLast", True) or not page.get("values"):
+            return emails
+
+
+def count_emails(emails):
+    """Count the emails that were found, leaving out hidden ones."""
+    return sum(1 for email in emails.values() if email)
+
+
+def resolve_emails(account_ids):
+    """Resolve emails for account IDs in batches, using the bulk user
+    endpoint and then the organisation's managed-user listing.
+
+    Hidden emails map to None. The IDs of batches that failed for good are
+    left out, unless the managed-user listing has their email.
+    """
+    batches = [
+        account_ids[start:start + BULK_BATCH_SIZE]
+        for start in range(0, len(account_ids), BULK_BATCH_SIZE)
+    ]
+    emails = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for batch_emails in executor.map(
+            lambda batch: retry_queue.call(
+                f"bulk lookup of {len(batch)} users", fetch_user_batch, batch,
+                default={},
+            ),
+            batches,
+        ):
+            emails.update(batch_emails)
+    for _, batch_emails in retry_queue.replay():
+        emails.update(batch_emails)
+    print(
+        f"Bulk user lookups resolved {count_emails(emails)} of "
+        f"{len(account_ids)} emails."
     )
-    group_data = response.json()
-    all_users.extend(group_data.get("values", []))
-
-# Create or open a CSV file named 'jira_users_from_group.csv' in write mode
-with open(
-    "jira_users_from_group.csv", "w", newline="", encoding="utf-8"
-) as file:
-    writer = csv.writer(file)
-    # Write the headers
-    writer.writerow(
-        [
-            "Account ID",
-            "User Display Name",
-            "User Email Address",
-            "Active Status",
-        ]
+
+    missing = [account_id for account_id in account_ids if not emails.get(account_id)]
+    if missing and ORG_ID and ACCESS_TOKEN:
+        directory = fetch_directory(ORG_ID, ACCESS_TOKEN)
+        for account_id in missing:
+            email = directory.get(account_id, {}).get("email")
+            if email:
+                emails[account_id] = email
+        print(f"Managed-user listing resolved {count_emails(emails)} emails in total.")
+    return emails
+
+
+def enrich_emails(users):
+    """Fill in the emails that `/group/member` left out, using the cache
+    first and batched lookups for the rest."""
+    missing = sorted(
+        {user["accountId"] for user in users if not user.get("emailAddress")}
     )
-    # Go through each user
-    for user in all_users:
-        # Write user data to the CSV file
+    if not missing:
+        return
+    cache = load_profile_cache()
+    to_resolve = [account_id for account_id in missing if account_id not in cache]
+    print(
+        f"{len(missing)} users have no visible email, "
+        f"{len(missing) - len(to_resolve)} found in the cache."
+    )
+    if to_resolve:
+        emails = resolve_emails(to_resolve)
+        resolved_at = time.time()
+        # Hidden emails are cached too, so they are not looked up again; the
+        # users of failed lookups are left out
+        for account_id, email in emails.items():
+            cache[account_id] = {"email": email, "resolved_at": resolved_at}
+        save_profile_cache(cache)
+
+    for user in users:
+        if not user.get("emailAddress"):
+            email = cache.get(user["accountId"], {}).get("email")
+            if email:
+                user["emailAddress"] = email
+
+
+def write_users_csv(users, output_file):
+    """Write one row per user to a CSV file."""
+    # Create or open the CSV file in write mode
+    with open(output_file, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        # Write the headers
         writer.writerow(
             [
-                user["accountId"],
-                user["displayName"],
-                user.get("emailAddress", "N/A"),
-                user["active"],
+                "Account ID",
+                "User Display Name",
+                "User Email Address",
+                "Active Status",
             ]
         )
+        # Go through each user
+        for user in users:
+            # Write user data to the CSV file
+            writer.writerow(
+                [
+                    user["accountId"],
+                    user["displayName"],
+                    user.get("emailAddress", "N/A"),
+                    user["active"],
+                ]
+            )
+
+
+def parse_args():
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description="Export the members of groups.")
+    parser.add_argument("--groups", nargs="+", metavar="NAME", help="groups to export")
+    parser.add_argument(
+        "--groups-file", metavar="FILE", help="file with one group name per line"
+    )
+    parser.add_argument(
+        "--pattern", metavar="GLOB", help="export every group matching GLOB"
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Export the members of EXPORT_GROUP_NAME, or of the groups given on
+    the command line, to CSV files."""
+    args = parse_args()
+    if args.groups or args.groups_file or args.pattern:
+        group_names = select_groups(args)
+        if not group_names:
+            print("No groups matched.")
+            sys.exit()
+        export_groups(group_names)
+        retry_queue.report()
+        return
+
+    try:
+        all_users = fetch_group_members(EXPORT_GROUP_NAME)
+    except requests.HTTPError as http_err:
+        # Check the HTTP status code
+        print(
+            "Failed to fetch data. HTTP Status Code: "
+            f"{http_err.response.status_code}"
+        )
+        print(http_err.response.text)
+        sys.exit()
+
+    # If users are empty, exit early
+    if not all_users:
+        print("No users found for the provided group.")
+        sys.exit()
+
+    enrich_emails(all_users)
+    write_users_csv(all_users, OUTPUT_FILE)
+    retry_queue.report()
+
+
+if __name__ == "__main__":
+    main()
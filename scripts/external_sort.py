@@ -0,0 +1,144 @@
+"""
+External merge sort for large CSV exports.
+
+Rows are read in chunks that fit comfortably in memory, each chunk is sorted
+and spilled to a temporary file as a sorted run, and the runs are then
+merged into the output. Exports of several gigabytes come out in a stable
+order without ever being held in memory. Temporary files go to the
+directory named by `TMPDIR`, or the system default.
+"""
+
+import csv
+import heapq
+import os
+import tempfile
+from typing import Callable, Iterable, Iterator, List, Sequence, Tuple
+
+DEFAULT_CHUNK_ROWS = 200_000
+# Runs merged at once; more than this are merged in several passes
+MAX_OPEN_RUNS = 128
+
+SortKey = Tuple[Tuple[str, ...], List[str]]
+
+
+def _read_rows(input_files: Sequence[str]) -> Tuple[List[str], Iterator[List[str]]]:
+    """Return the header of the first file and an iterator over the data
+    rows of every file."""
+    with open(input_files[0], newline="", encoding="utf-8") as csv_file:
+        header = next(csv.reader(csv_file), [])
+
+    def rows() -> Iterator[List[str]]:
+        for input_file in input_files:
+            with open(input_file, newline="", encoding="utf-8") as csv_file:
+                reader = csv.reader(csv_file)
+                next(reader, None)
+                yield from reader
+
+    return header, rows()
+
+
+def _spill_run(rows: List[List[str]], key: Callable, directory: str) -> str:
+    """Sort a chunk of rows and write it to a temporary run file."""
+    rows.sort(key=key)
+    descriptor, run_path = tempfile.mkstemp(suffix=".csv", dir=directory)
+    with os.fdopen(descriptor, "w", newline="", encoding="utf-8") as run_file:
+        csv.writer(run_file).writerows(rows)
+    return run_path
+
+
+def _read_run(run_path: str) -> Iterator[List[str]]:
+    """Yield the rows of a run file."""
+    with open(run_path, newline="", encoding="utf-8") as run_file:
+        yield from csv.reader(run_file)
+
+
+def _write_runs(
+    rows: Iterable[List[str]], key: Callable, directory: str, chunk_rows: int
+) -> List[str]:
+    """Split rows into sorted runs of at most `chunk_rows` rows."""
+    run_paths: List[str] = []
+    chunk: List[List[str]] = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            run_paths.append(_spill_run(chunk, key, directory))
+            chunk = []
+    if chunk:
+        run_paths.append(_spill_run(chunk, key, directory))
+    return run_paths
+
+
+def _merge_runs(
+    run_paths: List[str], key: Callable, directory: str
+) -> Iterator[List[str]]:
+    """Merge sorted runs, in several passes if there are too many to keep
+    open at once."""
+    while len(run_paths) > MAX_OPEN_RUNS:
+        merged_paths = []
+        for start in range(0, len(run_paths), MAX_OPEN_RUNS):
+            group = run_paths[start:start + MAX_OPEN_RUNS]
+            descriptor, run_path = tempfile.mkstemp(suffix=".csv", dir=directory)
+            with os.fdopen(descriptor, "w", newline="", encoding="utf-8") as run_file:
+                csv.writer(run_file).writerows(
+                    heapq.merge(*(_read_run(path) for path in group), key=key)
+                )
+            for path in group:
+                os.remove(path)
+            merged_paths.append(run_path)
+        run_paths = merged_paths
+    return heapq.merge(*(_read_run(run_path) for run_path in run_paths), key=key)
+
+
+def _drop_duplicates(rows: Iterable[List[str]]) -> Iterator[List[str]]:
+    """Drop rows equal to the row before them."""
+    previous = None
+    for row in rows:
+        if row != previous:
+            yield row
+        previous = row
+
+
+def _write_csv(
+    output_file: str, header: List[str], rows: Iterable[List[str]]
+) -> int:
+    """Write a header and rows to a CSV file, returning the row count."""
+    written = 0
+    with open(output_file, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+    return written
+
+
+def sort_csv(
+    input_files: Sequence[str],
+    output_file: str,
+    key_columns: Sequence[str],
+    unique: bool = False,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> int:
+    """Sort the rows of one or more CSV files with the same header into
+    `output_file`, using bounded memory.
+
+    Rows are ordered by `key_columns`, with the whole row as a tie-breaker,
+    so the output is identical however the input was ordered. With `unique`,
+    duplicate rows are written once. The output may be one of the inputs.
+    Returns the number of data rows written.
+    """
+    if not input_files:
+        raise ValueError("sort_csv needs at least one input file")
+    header, rows = _read_rows(input_files)
+    indexes = [header.index(column) for column in key_columns]
+
+    def key(row: List[str]) -> SortKey:
+        return tuple(row[index] for index in indexes), row
+
+    with tempfile.TemporaryDirectory(prefix="external_sort_") as directory:
+        run_paths = _write_runs(rows, key, directory, chunk_rows)
+        print(f"Sorting {len(input_files)} files through {len(run_paths)} runs...")
+        merged = _merge_runs(run_paths, key, directory)
+        if unique:
+            merged = _drop_duplicates(merged)
+        return _write_csv(output_file, header, merged)
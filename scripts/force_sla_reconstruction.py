@@ -22,13 +22,16 @@ The script includes two helper functions:
   the specified CSV file and returns a list of issue keys.
 2. `post_issue_key(issue_key)`: This function sends a POST request to the
   Jira API with the provided issue key as the payload. It prints a
-  success or failure message based on the API response.
+  success or failure message based on the API response, and raises an
+  error if the request failed.
 
 In the main logic, the script does the following:
 1. Calls `read_issue_keys_from_csv` to get a list of issue keys from the CSV
   file.
 2. If the list of issue keys is not empty, it calls `post_issue_key` with the
-  issue keys as the argument.
+  issue keys as the argument. Requests that fail with a transient error are
+  retried with backoff once every issue key has been sent, and anything that
+  still fails is reported at the end.
 3. If the list of issue keys is empty, it prints a message indicating that no
   issue keys were found in the CSV.
 
@@ -40,12 +43,15 @@ running the script.
 
 import csv
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 from typing import List
 
 import requests
 from requests.auth import HTTPBasicAuth
 
+from adaptive_concurrency import AdaptiveExecutor, AdaptiveLimiter
+from retry_queue import RetryQueue
+
 # Check if the .env var exists and load the environment variables
 env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
 if os.path.exists(env_path):
@@ -67,7 +73,12 @@ url = (
 )
 auth = HTTPBasicAuth(USER_EMAIL, API_TOKEN)
 CONTENT_TYPE = 'application/json'
-MAX_WORKERS = 50
+
+# Requests sent at once, adjusted to how the instance responds
+limiter = AdaptiveLimiter(initial=10, max_limit=100)
+
+# Requests that fail are replayed once every issue key has been sent
+retry_queue = RetryQueue()
 
 
 def post_issue_key(issue_key: str) -> None:
@@ -76,17 +87,21 @@ def post_issue_key(issue_key: str) -> None:
 
     Args:
        issue_key (str): The issue key to be included in the payload.
+
+    Raises:
+       requests.HTTPError: If the request was not successful.
     """
     headers = {'Content-Type': CONTENT_TYPE}
     payload = [issue_key]
     response = requests.post(url, json=payload, headers=headers, auth=auth,
-                             timeout=30)
+                             timeout=30, hooks={'response': limiter.observe})
     if response.ok:
         print(f'Request successful for issue key {issue_key}:', response.text)
     else:
         print(f'Request failed for issue key {issue_key} with status code:',
               response.status_code, 'and reason:', response.text)
     print(f'Response for issue key {issue_key}:', response.text)
+    response.raise_for_status()
 
 
 def read_issue_keys_from_csv(file_path: str) -> List[str]:
@@ -113,13 +128,18 @@ def read_issue_keys_from_csv(file_path: str) -> List[str]:
 if __name__ == '__main__':
     issue_keys_from_file = read_issue_keys_from_csv(CSV_FILE_PATH)
     if issue_keys_from_file:
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [executor.submit(post_issue_key, issue_key)
+        with AdaptiveExecutor(limiter) as executor:
+            futures = [executor.submit(retry_queue.call,
+                                       f'issue key {issue_key}',
+                                       post_issue_key, issue_key)
                        for issue_key in issue_keys_from_file]
             for future in as_completed(futures):
                 try:
                     future.result()
                 except requests.RequestException as exc:
                     print(f'Request generated an exception: {exc}')
+        retry_queue.replay()
+        retry_queue.report()
+        limiter.report()
     else:
         print('No issue keys found in the CSV.')
@@ -3,6 +3,8 @@ import json
 import os
 import requests
 
+import json_backend
+
 # Check if the .env var exists and load the environment variables
 env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
 if os.path.exists(env_path):
@@ -27,7 +29,7 @@ response = requests.request("GET", url, headers=headers, timeout=30)
 
 print(
     json.dumps(
-        json.loads(response.text),
+        json_backend.decode(response),
         sort_keys=True,
         indent=4,
         separators=(",", ": "),
@@ -1,12 +1,36 @@
-"""This script exports the audit logs for the last 30 days to a CSV file."""
+"""This script exports the audit logs for the last 30 days to a CSV file.
+
+With `--follow`, it instead keeps polling the events endpoint from a
+high-water mark and writes each new event as one JSON line, to stdout or to
+a rotating file given with `--output`. Every poll re-reads a short overlap
+behind the high-water mark, so events that are indexed late are not missed,
+and events already emitted are dropped by ID. Polling slows down while the
+organisation is quiet. The high-water mark is kept in
+`audit_follow_state.json`, so a restarted follower resumes where it stopped.
+
+The audit log names issues by key or, often, by numeric ID. When `JIRA_URL`,
+`USER_EMAIL` and `API_TOKEN` are set, the distinct issues of an export are
+resolved through the issue search, 100 per request, and the CSV gains their
+current key, project and summary. Resolved issues are cached in
+`issue_cache.json` across runs.
+"""
+import argparse
 import csv
 import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import json
+import logging
+from logging.handlers import RotatingFileHandler
 import os
 import queue
+import sys
+from time import sleep, time as now_seconds
 import requests
+from requests.auth import HTTPBasicAuth
+
+import json_backend
+from adaptive_concurrency import AdaptiveExecutor, AdaptiveLimiter
+from retry_queue import RetryQueue, retry_after
 
 # Check if the .env var exists and load the environment variables
 env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
@@ -21,24 +45,46 @@ ORG_ID = os.environ.get("ORG_ID")
 ACCESS_TOKEN = os.environ.get("ACCESS_TOKEN")
 BASE_URL = "https://api.atlassian.com/admin/v1/orgs"
 
+# Optional Jira site credentials, used to resolve issue IDs
+JIRA_URL = os.environ.get("JIRA_URL")
+USER_EMAIL = os.environ.get("USER_EMAIL")
+API_TOKEN = os.environ.get("API_TOKEN")
+
 # Set the date range for the last 30 days
 to_date = int(datetime.now().timestamp()) * 1000
 from_date = int((datetime.now() - timedelta(days=30)).timestamp()) * 1000
 
-# Ask user for the action type
-print("Please select the action type:")
-print("1. jira_issue_viewed")
-print("2. jira_issue_updated")
-action_choice = input("Enter your choice (1 or 2): ")
-
-# Set the ACTION based on user's choice
-if action_choice == "1":
-    ACTION = "jira_issue_viewed"
-elif action_choice == "2":
-    ACTION = "jira_issue_updated"
-else:
-    print("Invalid choice. Defaulting to jira_issue_updated")
-    ACTION = "jira_issue_updated"
+# Export the audit log events to a CSV file
+OUTPUT_FILE = "audit_logs.csv"
+CSV_HEADER = [
+    "Time",
+    "Action",
+    "Actor Name",
+    "Actor Email",
+    "Issue Key",
+    "Event ID",
+    "Resolved Issue Key",
+    "Project",
+    "Summary",
+]
+ACTIONS = ["jira_issue_viewed", "jira_issue_updated"]
+
+# Follow mode settings
+FOLLOW_STATE_FILE = "audit_follow_state.json"
+# Each poll re-reads this much behind the high-water mark for late events
+FOLLOW_OVERLAP_MS = 2 * 60 * 1000
+MIN_POLL_SECONDS = 5
+MAX_POLL_SECONDS = 60
+ROTATE_BYTES = 100 * 1024 * 1024
+ROTATE_BACKUPS = 10
+
+# Issue enrichment settings
+ISSUE_BATCH_SIZE = 100
+ISSUE_CACHE_FILE = os.environ.get("ISSUE_CACHE_FILE", "issue_cache.json")
+# Cached issues, and the fact that an issue was not found, expire after this
+ISSUE_CACHE_TTL = float(os.environ.get("ISSUE_CACHE_DAYS", "7")) * 86400
+# Columns written for issues that are not resolved
+UNRESOLVED_ISSUE = ("", "", "")
 
 # API endpoint URL
 url = f"{BASE_URL}/{ORG_ID}/events"
@@ -51,9 +97,19 @@ headers = {
 # Initialize an empty list to store the audit log events
 audit_logs = []
 
+# Query parameters sent with every page request; the action is set in main()
+query_params = {"from": from_date, "to": to_date}
+
 # Thread safe queue to store page URLs
 pages_queue = queue.Queue()
-pages_queue.put(url)
+
+# Pages that fail are replayed once the main pass has finished
+retry_queue = RetryQueue()
+
+# Pages fetched at once, adjusted to how the API responds
+limiter = AdaptiveLimiter(initial=10, max_limit=160)
+# Issue searches sent at once; the site is limited separately from the org API
+issue_limiter = AdaptiveLimiter(initial=4, max_limit=20)
 
 
 def fetch_page(page_url):
@@ -61,58 +117,202 @@ def fetch_page(page_url):
     response = requests.get(
         page_url,
         headers=headers,
-        params={"from": from_date, "to": to_date, "action": ACTION},
+        params=query_params,
         timeout=30,
+        stream=True,
+        hooks={"response": limiter.observe},
     )
-    print(
-        json.dumps(
-            json.loads(response.text),
-            sort_keys=True,
-            indent=4,
-            separators=(",", ": "),
-        )
-    )
-    if response.status_code == 200:
-        data = response.json()
-        audit_logs.extend(data["data"])
-        # Check if there's a next page and update the URL
-        next_page = data["links"].get("next")
-        if next_page:
-            pages_queue.put(next_page)
-    else:
+    if response.status_code != 200:
+        response.close()
         print(f"Error retrieving audit log events: {response.status_code}")
+        raise requests.HTTPError(
+            f"{response.status_code} for {page_url}", response=response
+        )
 
+    # Parse the events one at a time as the page streams in
+    page_envelope = {}
+    events = list(json_backend.iter_array(response, "data", page_envelope))
+    audit_logs.extend(events)
+    # Check if there's a next page and update the URL
+    next_page = page_envelope.get("links", {}).get("next")
+    if next_page:
+        pages_queue.put(next_page)
+    return True
 
-# Start thread pool executor with 10 threads
-with ThreadPoolExecutor(max_workers=160) as executor:
-    futures = {executor.submit(fetch_page, pages_queue.get())}
-    while futures:
-        done, futures = concurrent.futures.wait(
-            futures, return_when=concurrent.futures.FIRST_COMPLETED
-        )
 
-        for future in done:
-            # Here you can add error handling on exception
-            if future.exception() is not None:
-                print(
-                    f"Error retrieving audit log events: \
-                        {future.exception()}"
+def crawl_pages():
+    """Fetch every page in the pages queue, following the next page links."""
+    with AdaptiveExecutor(limiter) as executor:
+        page_urls = {}
+        while page_urls or not pages_queue.empty():
+            while not pages_queue.empty():
+                page_url = pages_queue.get()
+                future = executor.submit(
+                    retry_queue.call,
+                    f"audit log page {page_url}",
+                    fetch_page,
+                    page_url,
+                    default=False,
                 )
-            else:
-                print("Page processed successfully")
-        while not pages_queue.empty():
-            futures.add(executor.submit(fetch_page, pages_queue.get()))
+                page_urls[future] = page_url
+            done, _ = concurrent.futures.wait(
+                page_urls, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for future in done:
+                page_url = page_urls.pop(future)
+                # Here you can add error handling on exception
+                if future.exception() is not None:
+                    print(
+                        f"Error retrieving audit log events: \
+                            {future.exception()}"
+                    )
+                    # Not a failed request, so the page is not retried, but
+                    # it and the pages after it are reported as missing
+                    retry_queue.add(
+                        f"audit log page {page_url}",
+                        fetch_page,
+                        (page_url,),
+                        future.exception(),
+                    )
+                elif future.result():
+                    print("Page processed successfully")
+
+
+def prompt_action():
+    """Ask the user for the action type to export."""
+    print("Please select the action type:")
+    print("1. jira_issue_viewed")
+    print("2. jira_issue_updated")
+    action_choice = input("Enter your choice (1 or 2): ")
+
+    # Set the action based on user's choice
+    if action_choice == "1":
+        return "jira_issue_viewed"
+    if action_choice == "2":
+        return "jira_issue_updated"
+    print("Invalid choice. Defaulting to jira_issue_updated")
+    return "jira_issue_updated"
+
+
+def load_issue_cache():
+    """Load the cached issues that have not expired, keyed by issue key or
+    ID as it appears in the audit log."""
+    if not os.path.exists(ISSUE_CACHE_FILE):
+        return {}
+    with open(ISSUE_CACHE_FILE, encoding="utf-8") as cache_file:
+        cache = json.load(cache_file)
+    oldest = now_seconds() - ISSUE_CACHE_TTL
+    return {
+        key_or_id: entry
+        for key_or_id, entry in cache.items()
+        if entry["resolved_at"] >= oldest
+    }
+
+
+def save_issue_cache(cache):
+    """Write the issue cache back to disk."""
+    with open(ISSUE_CACHE_FILE, "w", encoding="utf-8") as cache_file:
+        json.dump(cache, cache_file)
 
-# Export the audit log events to a CSV file
-OUTPUT_FILE = "audit_logs.csv"
 
-with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as csvfile:
-    writer = csv.writer(csvfile)
-    writer.writerow(
-        ["Time", "Action", "Actor Name", "Actor Email", "Issue Key"]
+def search_issues(keys_or_ids):
+    """Look up a batch of issue keys or IDs with one issue search.
+
+    Returns the (key, project, summary) of each issue keyed by the key or
+    ID it was looked up with, or None for issues that do not exist or are
+    not visible.
+    """
+    terms = ", ".join(
+        key_or_id if key_or_id.isdigit() else f'"{key_or_id}"'
+        for key_or_id in keys_or_ids
+    )
+    response = requests.post(
+        f"{JIRA_URL}/rest/api/3/search",
+        headers={"Accept": "application/json"},
+        json={
+            "jql": f"issue in ({terms})",
+            "fields": ["summary", "project"],
+            "maxResults": len(keys_or_ids),
+            # Report unknown issues as warnings instead of failing the batch
+            "validateQuery": "warn",
+        },
+        auth=HTTPBasicAuth(USER_EMAIL, API_TOKEN),
+        timeout=60,
+        hooks={"response": issue_limiter.observe},
     )
+    response.raise_for_status()
+    found = {}
+    for issue in json_backend.decode(response).get("issues", []):
+        resolved = (
+            issue["key"],
+            issue["fields"].get("project", {}).get("key", ""),
+            issue["fields"].get("summary", ""),
+        )
+        found[issue["id"]] = resolved
+        found[issue["key"]] = resolved
+    return {key_or_id: found.get(key_or_id) for key_or_id in keys_or_ids}
+
+
+def resolve_issues(logs):
+    """Resolve the distinct issues of the audit log events to their key,
+    project and summary, using the cache first and batched issue searches
+    for the rest."""
+    keys_or_ids = sorted(
+        {
+            container["attributes"]["issueKeyOrId"]
+            for log in logs
+            for container in log["attributes"]["container"]
+        }
+    )
+    cache = load_issue_cache()
+    to_resolve = [key_or_id for key_or_id in keys_or_ids if key_or_id not in cache]
+    print(
+        f"Resolving {len(keys_or_ids)} distinct issues, "
+        f"{len(keys_or_ids) - len(to_resolve)} found in the cache."
+    )
+    batches = [
+        to_resolve[start:start + ISSUE_BATCH_SIZE]
+        for start in range(0, len(to_resolve), ISSUE_BATCH_SIZE)
+    ]
+    found = {}
+    with AdaptiveExecutor(issue_limiter) as executor:
+        for batch_found in executor.map(
+            lambda batch: retry_queue.call(
+                f"issue search for {len(batch)} issues", search_issues, batch,
+                default=None,
+            ),
+            batches,
+        ):
+            found.update(batch_found or {})
+    for _, batch_found in retry_queue.replay():
+        found.update(batch_found)
+
+    # Issues that were not found are cached too, so they are not searched
+    # again; the issues of failed searches are left out
+    resolved_at = now_seconds()
+    for key_or_id, resolved in found.items():
+        cache[key_or_id] = {
+            "key": resolved[0] if resolved else None,
+            "project": resolved[1] if resolved else None,
+            "summary": resolved[2] if resolved else None,
+            "resolved_at": resolved_at,
+        }
+    save_issue_cache(cache)
 
-    for log in audit_logs:
+    return {
+        key_or_id: (entry["key"], entry["project"], entry["summary"])
+        for key_or_id, entry in cache.items()
+        if entry["key"] is not None
+    }
+
+
+def write_audit_rows(writer, logs, issues=None):
+    """Write one CSV row per container of each audit log event, with the
+    resolved key, project and summary of the issue from `issues`."""
+    issues = issues or {}
+    for log in logs:
+        event_id = log["id"]
         attributes = log["attributes"]
         time = attributes["time"]
         action = attributes["action"]
@@ -121,6 +321,182 @@ with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as csvfile:
         # assuming that attributes["container"] is a list of dictionaries
         for container in attributes["container"]:
             issue_key = container["attributes"]["issueKeyOrId"]
-            writer.writerow([time, action, actor_name, actor_email, issue_key])
+            writer.writerow(
+                (time, action, actor_name, actor_email, issue_key, event_id)
+                + issues.get(issue_key, UNRESOLVED_ISSUE)
+            )
+
+
+def now_ms():
+    """The current time in milliseconds since the epoch."""
+    return int(datetime.now().timestamp() * 1000)
+
+
+def event_time_ms(event):
+    """The time of an audit log event in milliseconds since the epoch."""
+    event_time = event["attributes"]["time"].replace("Z", "+00:00")
+    return int(datetime.fromisoformat(event_time).timestamp() * 1000)
+
+
+def fetch_window(params):
+    """Fetch every event matching `params`, following the next page links."""
+    events = []
+    page_url = url
+    while page_url:
+        response = requests.get(
+            page_url, headers=headers, params=params, timeout=30, stream=True
+        )
+        response.raise_for_status()
+        page_envelope = {}
+        events.extend(json_backend.iter_array(response, "data", page_envelope))
+        page_url = page_envelope.get("links", {}).get("next")
+    return events
+
+
+def load_follow_state():
+    """Return the saved high-water mark and the recently emitted event IDs,
+    or start from the current time."""
+    if not os.path.exists(FOLLOW_STATE_FILE):
+        return now_ms(), {}
+    with open(FOLLOW_STATE_FILE, encoding="utf-8") as state_file:
+        state = json.load(state_file)
+    return state["high_water"], state["seen"]
+
+
+def save_follow_state(high_water, seen):
+    """Save the high-water mark and the recently emitted event IDs."""
+    with open(FOLLOW_STATE_FILE, "w", encoding="utf-8") as state_file:
+        json.dump({"high_water": high_water, "seen": seen}, state_file)
+
+
+def make_event_logger(output_file):
+    """Return a logger that writes one event per line to stdout, or to a
+    rotating file."""
+    event_logger = logging.getLogger("audit_events")
+    event_logger.propagate = False
+    event_logger.setLevel(logging.INFO)
+    if output_file:
+        handler = RotatingFileHandler(
+            output_file,
+            maxBytes=ROTATE_BYTES,
+            backupCount=ROTATE_BACKUPS,
+            encoding="utf-8",
+        )
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    event_logger.addHandler(handler)
+    return event_logger
+
+
+def poll_events(action, high_water, seen, emit):
+    """Fetch the events since the high-water mark, less the overlap, and
+    emit the ones not emitted before in time order.
+
+    Returns the new high-water mark and the number of events emitted.
+    """
+    window_to = now_ms()
+    params = {"from": high_water - FOLLOW_OVERLAP_MS, "to": window_to}
+    if action:
+        params["action"] = action
+    emitted = 0
+    for event in sorted(fetch_window(params), key=event_time_ms):
+        if event["id"] in seen:
+            continue
+        seen[event["id"]] = event_time_ms(event)
+        emit(json.dumps(event, separators=(",", ":")))
+        emitted += 1
+
+    # Forget the events that the next window can no longer return
+    cutoff = window_to - FOLLOW_OVERLAP_MS
+    for event_id in [event_id for event_id, at in seen.items() if at < cutoff]:
+        del seen[event_id]
+    return window_to, emitted
+
+
+def follow(action, output_file):
+    """Poll for new audit log events until interrupted."""
+    event_logger = make_event_logger(output_file)
+    high_water, seen = load_follow_state()
+    delay = MIN_POLL_SECONDS
+    while True:
+        try:
+            high_water, emitted = poll_events(
+                action, high_water, seen, event_logger.info
+            )
+        except (requests.RequestException, ValueError) as error:
+            # A dropped connection or a garbled page only skips this poll
+            print(f"Polling failed, backing off: {error}", file=sys.stderr)
+            delay = max(min(delay * 2, MAX_POLL_SECONDS), retry_after(error))
+        else:
+            save_follow_state(high_water, seen)
+            if emitted:
+                print(f"Emitted {emitted} new events", file=sys.stderr)
+            # Poll quickly while events arrive, and back off while quiet
+            delay = (
+                MIN_POLL_SECONDS if emitted else min(delay * 2, MAX_POLL_SECONDS)
+            )
+        sleep(delay)
+
+
+def parse_args():
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description="Export or follow audit logs.")
+    parser.add_argument(
+        "--action",
+        choices=ACTIONS,
+        help="action to export; asked for if omitted, all actions with --follow",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="keep polling for new events and write them as JSON lines",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        help="with --follow, write to a rotating FILE instead of stdout",
+    )
+    args = parser.parse_args()
+    if args.output and not args.follow:
+        parser.error("--output can only be used with --follow")
+    return args
+
+
+def main():
+    """Fetch the audit log events and export them to a CSV file."""
+    args = parse_args()
+    if args.follow:
+        try:
+            follow(args.action, args.output)
+        except KeyboardInterrupt:
+            print("Stopped following audit log events", file=sys.stderr)
+        return
+
+    query_params["action"] = args.action or prompt_action()
+
+    pages_queue.put(url)
+    crawl_pages()
+    # Replay failed pages, then follow the next links of the recovered ones
+    while retry_queue:
+        retry_queue.replay()
+        crawl_pages()
+
+    issues = {}
+    if JIRA_URL and USER_EMAIL and API_TOKEN:
+        issues = resolve_issues(audit_logs)
+    else:
+        print("JIRA_URL, USER_EMAIL or API_TOKEN not set, issues not resolved")
+    retry_queue.report()
+    limiter.report()
+
+    with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(CSV_HEADER)
+        write_audit_rows(writer, audit_logs, issues)
+
+    print(f"Audit logs exported to {OUTPUT_FILE}")
+
 
-print(f"Audit logs exported to {OUTPUT_FILE}")
+if __name__ == "__main__":
+    main()
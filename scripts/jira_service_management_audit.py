@@ -1,11 +1,44 @@
-"""Script to fetch issue changelogs from JIRA."""
-from concurrent.futures import ThreadPoolExecutor, as_completed
+"""Script to fetch issue changelogs from JIRA.
+
+The audit can be split into N deterministic shards, by project or by
+update-time slice, so that separate processes or machines can each export
+one shard to its own file. The shard files are then combined and
+deduplicated with `--merge`:
+
+    python jira_service_management_audit.py --shard 1/4 --shard-by project
+    python jira_service_management_audit.py --merge changelog.shard-*.csv
+
+Changelogs are written in the order they are fetched. `--sort` orders the
+output by issue and date with an external merge sort, so that runs can be
+diffed; merged output is always sorted.
+
+`--incremental` keeps a watermark per issue, the number of histories already
+exported and the ID of the last one, in a state file next to the output.
+Later incremental runs only search the issues updated since the previous
+run, fetch each changelog from the watermark on and append the new
+histories to the output, so a daily run costs about one day of change.
+Each watermark also records when a run last found its issue, and issues
+that have not been found for `UPDATED_WITHIN_DAYS` are dropped from the
+state; if such an issue is updated again, its changelog is appended in
+full.
+"""
+from concurrent.futures import as_completed
+from datetime import datetime, timedelta, timezone
+import argparse
 import csv
+import glob
+import json
 import os
 import math
+import zlib
 import requests
 from requests.auth import HTTPBasicAuth
 
+import json_backend
+from adaptive_concurrency import AdaptiveExecutor, AdaptiveLimiter
+from external_sort import sort_csv
+from retry_queue import RetryQueue
+
 # Load environment variables from .env file
 env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
 if os.path.exists(env_path):
@@ -20,7 +53,15 @@ USER_EMAIL = os.environ.get("USER_EMAIL")
 API_TOKEN = os.environ.get("API_TOKEN")
 
 # Define JQL query
-JQL_QUERY = "projectType = service_desk and updated >= -30d"
+JQL_FILTER = "projectType = service_desk"
+UPDATED_WITHIN_DAYS = 30
+JQL_QUERY = f"{JQL_FILTER} and updated >= -{UPDATED_WITHIN_DAYS}d"
+OUTPUT_FILE = "changelog.csv"
+CSV_HEADER = ["Actor", "Issue", "Date", "History ID"]
+JQL_DATE_FORMAT = "%Y-%m-%d %H:%M"
+# Incremental runs also search this far before the previous run started
+INCREMENTAL_OVERLAP_MINUTES = 15
+SORT_COLUMNS = ["Issue", "Date", "History ID"]
 
 # Define headers
 headers = {"Accept": "application/json"}
@@ -28,116 +69,444 @@ headers = {"Accept": "application/json"}
 # Authenticate with JIRA API
 auth = HTTPBasicAuth(USER_EMAIL, API_TOKEN)
 
-MAX_THREADS = 10
-MAX_RESULTS = 50
+# Upper bound on the requests sent at once; the limiter finds the actual value
+MAX_THREADS = 64
+# Largest page sizes the search and changelog endpoints accept
+MAX_RESULTS = 100
+CHANGELOG_PAGE_SIZE = 100
+# Only the issue key is read from search results
+SEARCH_FIELDS = "key"
 
+# Requests that fail are replayed once each pass has finished
+retry_queue = RetryQueue()
 
-def get_issue_keys(start_at):
+# Requests sent at once, adjusted to how the instance responds
+limiter = AdaptiveLimiter(initial=10, max_limit=MAX_THREADS)
+HOOKS = {"response": limiter.observe}
+
+# Share one connection pool between the worker threads
+session = requests.Session()
+session.headers.update(headers)
+session.auth = auth
+session.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_maxsize=MAX_THREADS)
+)
+
+
+def get_issue_keys(start_at, jql=JQL_QUERY):
     """Fetch a page of issue keys starting at start_at."""
-    try:
-        response = requests.request(
-            "GET",
-            f"{JIRA_URL}/rest/api/3/search?jql={JQL_QUERY}"
-            f"&startAt={start_at * MAX_RESULTS}&maxResults={MAX_RESULTS}",
-            headers=headers,
-            auth=auth,
-            timeout=120,
-        )
-        response.raise_for_status()
-        data = response.json()
-        print(
-            f"Added {len(data['issues'])} issue keys, "
-            f"total is now {start_at * MAX_RESULTS + len(data['issues'])}"
-        )
-        return [issue["key"] for issue in data["issues"]]
-    except requests.HTTPError as http_err:
-        print(f"Failed to get issue keys: {http_err}")
-        return []
+    response = session.request(
+        "GET",
+        f"{JIRA_URL}/rest/api/3/search",
+        params={
+            "jql": jql,
+            "fields": SEARCH_FIELDS,
+            "startAt": start_at * MAX_RESULTS,
+            "maxResults": MAX_RESULTS,
+        },
+        timeout=120,
+        hooks=HOOKS,
+    )
+    response.raise_for_status()
+    data = json_backend.decode(response)
+    print(
+        f"Added {len(data['issues'])} issue keys, "
+        f"total is now {start_at * MAX_RESULTS + len(data['issues'])}"
+    )
+    return [issue["key"] for issue in data["issues"]]
 
 
-def get_total_issues():
+def get_total_issues(jql=JQL_QUERY):
     """Fetch the total number of issues to be fetched."""
-    try:
-        response = requests.request(
+    # Not seen by the limiter: a count returns far faster than a page of the
+    # same search, and would not tell it anything about the load
+    response = session.request(
+        "GET",
+        f"{JIRA_URL}/rest/api/3/search",
+        params={"jql": jql, "fields": SEARCH_FIELDS, "maxResults": 0},
+        timeout=120,
+    )
+    response.raise_for_status()
+    return json_backend.decode(response)["total"]
+
+
+def fetch_histories(issue_key, start_at=0):
+    """Fetch the histories of an issue from `start_at` on.
+
+    The paginated changelog endpoint returns only the histories, instead of
+    the whole issue body that `expand=changelog` would download. Returns the
+    histories and the number of histories the issue has.
+    """
+    histories = []
+    while True:
+        response = session.request(
             "GET",
-            f"{JIRA_URL}/rest/api/3/search?jql={JQL_QUERY}&maxResults=1",
-            headers=headers,
-            auth=auth,
+            f"{JIRA_URL}/rest/api/3/issue/{issue_key}/changelog",
+            params={"startAt": start_at, "maxResults": CHANGELOG_PAGE_SIZE},
             timeout=120,
+            hooks=HOOKS,
         )
         response.raise_for_status()
-        return response.json()["total"]
-    except requests.HTTPError as http_err:
-        print(f"Failed to get total issues: {http_err}")
-        return 0
+        page = json_backend.decode(response)
+        histories.extend(page.get("values", []))
+        start_at += len(page.get("values", []))
+        if page.get("isLast", True) or not page.get("values"):
+            return histories, start_at
 
 
 def get_issue_changelog(issue_key):
     """Fetch the changelog for a specific issue."""
     print(f"Fetching changelog for issue {issue_key}...")
-    try:
-        issue_response = requests.request(
+    histories, _ = fetch_histories(issue_key)
+    if not histories:
+        print(f"No changelog found for issue {issue_key}")
+        return []
+
+    return build_changelog_rows(issue_key, histories)
+
+
+def get_new_changelog(issue_key, watermark):
+    """Fetch the histories of an issue added after its watermark.
+
+    The page starts at the last exported history, which must still have the
+    watermark's ID; if it does not, the changelog changed underneath (for
+    example a history was deleted) and the whole changelog is fetched and
+    filtered by ID instead. Returns the new rows and the new watermark.
+    """
+    print(f"Fetching new changelog for issue {issue_key}...")
+    if watermark:
+        histories, count = fetch_histories(issue_key, watermark["count"] - 1)
+        if histories and histories[0]["id"] == watermark["last_id"]:
+            new_histories = histories[1:]
+        else:
+            print(f"Changelog of {issue_key} changed, fetching it in full")
+            histories, count = fetch_histories(issue_key)
+            new_histories = [
+                history
+                for history in histories
+                if int(history["id"]) > int(watermark["last_id"])
+            ]
+    else:
+        histories, count = fetch_histories(issue_key)
+        new_histories = histories
+
+    if histories:
+        watermark = {"count": count, "last_id": histories[-1]["id"]}
+    return build_changelog_rows(issue_key, new_histories), watermark
+
+
+def build_changelog_rows(issue_key, histories):
+    """Build the CSV rows for the histories of an issue."""
+    return [
+        (
+            history.get("author", {}).get("emailAddress", "No email provided"),
+            issue_key,
+            history["created"],
+            history["id"],
+        )
+        for history in histories
+    ]
+
+
+def get_service_desk_projects():
+    """Fetch the keys of every service desk project."""
+    project_keys = []
+    start_at = 0
+    while True:
+        response = session.request(
             "GET",
-            f"{JIRA_URL}/rest/api/3/issue/{issue_key}?expand=changelog",
-            headers=headers,
-            auth=auth,
+            f"{JIRA_URL}/rest/api/3/project/search",
+            params={
+                "typeKey": "service_desk",
+                "startAt": start_at,
+                "maxResults": 50,
+            },
             timeout=120,
+            hooks=HOOKS,
         )
-        issue_response.raise_for_status()
+        response.raise_for_status()
+        page = json_backend.decode(response)
+        project_keys += [project["key"] for project in page.get("values", [])]
+        start_at += len(page.get("values", []))
+        if page.get("isLast", True) or not page.get("values"):
+            return project_keys
 
-        issue_data = issue_response.json()
-        changelog = issue_data.get("changelog", {})
 
-        if not changelog.get("histories"):
-            print(f"No changelog found for issue {issue_key}")
-            return []
+def project_shard_jql(shard_index, shard_count):
+    """Build the JQL for the projects that hash into the given shard.
 
-        return [
-            (
-                history.get("author", {}).get(
-                    "emailAddress", "No email provided"
-                ),
-                issue_key,
-                history["created"],
-            )
-            for history in changelog["histories"]
-        ]
-    except requests.HTTPError as http_err:
-        print(f"Failed to get changelog for issue {issue_key}: {http_err}")
-        return []
+    Projects are assigned by a CRC32 of their key, so a project always lands
+    in the same shard whichever machine runs it. Returns None if no project
+    falls into the shard.
+    """
+    project_keys = [
+        project_key
+        for project_key in get_service_desk_projects()
+        if zlib.crc32(project_key.encode("utf-8")) % shard_count == shard_index - 1
+    ]
+    print(f"Shard {shard_index}/{shard_count} covers projects: {project_keys}")
+    if not project_keys:
+        return None
+    projects = ", ".join(f'"{project_key}"' for project_key in project_keys)
+    return (
+        f"{JQL_FILTER} and project in ({projects}) "
+        f"and updated >= -{UPDATED_WITHIN_DAYS}d"
+    )
 
 
-def run():
-    """Main function to run the script."""
-    print("Executing search query...")
-    total_issues = get_total_issues()
+def time_shard_jql(shard_index, shard_count, anchor):
+    """Build the JQL for one equal slice of the update-time window.
+
+    The window ends at `anchor`, which every worker must share. The first
+    slice starts at the beginning of the window and the last slice is left
+    open-ended, so the slices cover the window exactly once between them.
+    Jira reads the dates in the account's time zone, which shifts every
+    slice by the same offset and so keeps them a partition.
+    """
+    window_start = anchor - timedelta(days=UPDATED_WITHIN_DAYS)
+    width = timedelta(days=UPDATED_WITHIN_DAYS) / shard_count
+    start = window_start + width * (shard_index - 1)
+    conditions = [f'updated >= "{start.strftime(JQL_DATE_FORMAT)}"']
+    if shard_index < shard_count:
+        end = start + width
+        conditions.append(f'updated < "{end.strftime(JQL_DATE_FORMAT)}"')
+    return f"{JQL_FILTER} and {' and '.join(conditions)}"
+
+
+def merge_outputs(input_files, output_file):
+    """Combine changelog CSVs into one sorted file, dropping duplicate
+    histories."""
+    written = sort_csv(input_files, output_file, SORT_COLUMNS, unique=True)
+    print(f"Merged {len(input_files)} files into {output_file} ({written} rows).")
+
+
+def collect_issue_keys(jql):
+    """Collect the keys of every issue matching the JQL query."""
+    print(f"Executing search query: {jql}")
+    total_issues = retry_queue.call(
+        "issue count", get_total_issues, jql, default=0
+    )
+    for _, result in retry_queue.replay():
+        total_issues = result
     issue_keys = []
-    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+    with AdaptiveExecutor(limiter) as executor:
         futures = {
-            executor.submit(get_issue_keys, start_at): start_at
+            executor.submit(
+                retry_queue.call,
+                f"issue key page {start_at}",
+                get_issue_keys,
+                start_at,
+                jql,
+                default=[],
+            ): start_at
             for start_at in range(math.ceil(total_issues / MAX_RESULTS))
         }
         for future in as_completed(futures):
             issue_keys += future.result()
+    for _, result in retry_queue.replay():
+        issue_keys += result
     print(f"Collected {len(issue_keys)} issue keys.")
+    return issue_keys
+
+
+def fetch_changelog(issue_key, state=None, seen=None):
+    """Fetch the changelog rows of an issue, or with an incremental state,
+    only the new ones, moving the issue's watermark on and stamping it with
+    `seen`, the start of the run that found the issue."""
+    if state is None:
+        return get_issue_changelog(issue_key)
+    rows, watermark = get_new_changelog(issue_key, state["issues"].get(issue_key))
+    if watermark:
+        state["issues"][issue_key] = {**watermark, "seen": seen}
+    return rows
+
+
+def state_file_for(output_file):
+    """The incremental state file that belongs to an output file."""
+    return f"{os.path.splitext(output_file)[0]}.state.json"
+
+
+def load_state(output_file):
+    """Load the incremental state of an output file.
+
+    Without a state file, or without the output it describes, the run starts
+    over with an empty state.
+    """
+    state_file = state_file_for(output_file)
+    if not (os.path.exists(state_file) and os.path.exists(output_file)):
+        return {"last_run": None, "issues": {}}
+    with open(state_file, encoding="utf-8") as file_handle:
+        return json.load(file_handle)
+
+
+def save_state(output_file, state):
+    """Save the incremental state of an output file."""
+    with open(state_file_for(output_file), "w", encoding="utf-8") as file_handle:
+        json.dump(state, file_handle)
+
+
+def prune_state(state, now):
+    """Drop the watermarks of the issues that no run has found within the
+    last `UPDATED_WITHIN_DAYS`, as the search no longer returns them.
+
+    Watermarks saved before runs were stamped count as found by the
+    previous run.
+    """
+    horizon = now - timedelta(days=UPDATED_WITHIN_DAYS)
+    kept = {}
+    for issue_key, watermark in state["issues"].items():
+        seen = watermark.get("seen", state["last_run"])
+        if seen is None or datetime.fromisoformat(seen) >= horizon:
+            kept[issue_key] = watermark
+    print(f"Dropped {len(state['issues']) - len(kept)} issues from the state.")
+    state["issues"] = kept
 
+
+def updated_since_jql(jql, last_run, now):
+    """Narrow a JQL query to the issues updated since the previous run.
+
+    A relative time is used, because Jira reads absolute dates in the
+    account's time zone.
+    """
+    elapsed = now - datetime.fromisoformat(last_run)
+    minutes = math.ceil(elapsed.total_seconds() / 60) + INCREMENTAL_OVERLAP_MINUTES
+    return f"{jql} and updated >= -{minutes}m"
+
+
+def run(jql=JQL_QUERY, output_file=OUTPUT_FILE, sort_output=False, incremental=False):
+    """Main function to run the script."""
+    started = datetime.now(timezone.utc)
+    state = load_state(output_file) if incremental else None
+    if state and state["last_run"] and jql:
+        print(f"Exporting histories added since {state['last_run']}")
+        jql = updated_since_jql(jql, state["last_run"], started)
+    issue_keys = collect_issue_keys(jql) if jql else []
+
+    # Incremental runs append to the output of the previous run
+    append = bool(state and state["last_run"])
     print("Fetching changelogs...")
-    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+    with AdaptiveExecutor(limiter) as executor:
         futures = {
-            executor.submit(get_issue_changelog, issue_key): issue_key
+            executor.submit(
+                retry_queue.call,
+                f"changelog for issue {issue_key}",
+                fetch_changelog,
+                issue_key,
+                state,
+                started.isoformat(),
+                default=[],
+            ): issue_key
             for issue_key in issue_keys
         }
         with open(
-            "changelog.csv", "w", newline="", encoding="UTF-8"
+            output_file, "a" if append else "w", newline="", encoding="UTF-8"
         ) as csv_file:
             writer = csv.writer(csv_file)
-            writer.writerow(["Actor", "Issue", "Date"])
+            if not append:
+                writer.writerow(CSV_HEADER)
             for future in as_completed(futures):
                 result = future.result()
                 for row in result:
                     writer.writerow(row)
-    print("Changelogs fetched and written to CSV.")
+            for _, result in retry_queue.replay():
+                writer.writerows(result)
+    print(f"Changelogs fetched and written to {output_file}.")
+    if sort_output:
+        sort_csv([output_file], output_file, SORT_COLUMNS)
+        print(f"Sorted {output_file} by {', '.join(SORT_COLUMNS)}.")
+    if state is not None:
+        # Issues that failed must be searched again, so only move the start
+        # of the next search on when every changelog was fetched
+        if not retry_queue.failed:
+            state["last_run"] = started.isoformat()
+        prune_state(state, started)
+        save_state(output_file, state)
+    retry_queue.report()
+    limiter.report()
+
+
+def parse_shard(shard):
+    """Parse a shard given as INDEX/COUNT, e.g. 2/8."""
+    try:
+        shard_index, shard_count = (int(part) for part in shard.split("/"))
+    except ValueError as error:
+        raise argparse.ArgumentTypeError("expected INDEX/COUNT, e.g. 2/8") from error
+    if not 1 <= shard_index <= shard_count:
+        raise argparse.ArgumentTypeError("INDEX must be between 1 and COUNT")
+    return shard_index, shard_count
+
+
+def parse_anchor(anchor):
+    """Parse the end of the time window as a UTC "YYYY-MM-DD HH:MM"."""
+    return datetime.strptime(anchor, JQL_DATE_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def main():
+    """Parse the command line and run the audit, one shard, or a merge."""
+    parser = argparse.ArgumentParser(description="Export JSM issue changelogs.")
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="only export shard INDEX of COUNT, e.g. 2/8",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=["project", "time"],
+        default="project",
+        help="split by project key hash or by update-time slice",
+    )
+    parser.add_argument(
+        "--anchor",
+        type=parse_anchor,
+        default=datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0),
+        help="end of the time window for --shard-by time, as UTC "
+        '"YYYY-MM-DD HH:MM"; every shard must use the same value '
+        "(defaults to the current hour)",
+    )
+    parser.add_argument(
+        "--sort",
+        action="store_true",
+        help="sort the output by issue and date",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only export the histories added since the previous incremental run",
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        metavar="FILE",
+        help=f"merge and deduplicate shard outputs into {OUTPUT_FILE}",
+    )
+    args = parser.parse_args()
+    if args.incremental and args.shard and args.shard_by == "time":
+        parser.error("--incremental cannot be used with --shard-by time")
+
+    if args.merge:
+        # Expand patterns ourselves so merges also work where the shell won't
+        input_files = sorted(
+            {path for pattern in args.merge for path in glob.glob(pattern)}
+        )
+        if not input_files:
+            parser.error(f"no files match {' '.join(args.merge)}")
+        merge_outputs(input_files, OUTPUT_FILE)
+    elif args.shard:
+        shard_index, shard_count = args.shard
+        if args.shard_by == "project":
+            jql = project_shard_jql(shard_index, shard_count)
+        else:
+            print(f"Time window ends at {args.anchor.strftime(JQL_DATE_FORMAT)} UTC")
+            jql = time_shard_jql(shard_index, shard_count, args.anchor)
+        run(
+            jql,
+            f"changelog.shard-{shard_index}-of-{shard_count}.csv",
+            args.sort,
+            args.incremental,
+        )
+    else:
+        run(sort_output=args.sort, incremental=args.incremental)
 
 
 if __name__ == "__main__":
-    run()
+    main()
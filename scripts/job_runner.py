@@ -0,0 +1,135 @@
+"""
+Runs several admin scripts at once in one process, sharing one request
+budget per API host (see `request_budget.py`), so that concurrent jobs
+against the same organisation do not starve each other or trigger 429s.
+
+Each job is a quoted command line whose script name may carry a priority
+after a colon. Requests from higher-priority jobs are sent first when the
+budget runs short, so an interactive job can pre-empt background exports:
+
+    python job_runner.py "license_export.py" \\
+        "jira_edit_audit.py --action jira_issue_updated" \\
+        "remove_users_from_group.py:10 --sync desired.csv"
+
+Scripts that prompt for input need their answers on the command line, and
+their output is interleaved on stdout.
+"""
+
+import argparse
+import contextvars
+import os
+import runpy
+import shlex
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from request_budget import RequestBudget, request_priority
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The command line of the job running in the current context
+job_argv: contextvars.ContextVar[Optional[List[str]]] = contextvars.ContextVar(
+    "job_argv", default=None
+)
+
+
+class Job(NamedTuple):
+    """A script to run, with its priority and arguments."""
+
+    script: str
+    priority: int
+    args: Tuple[str, ...]
+
+
+def parse_job(spec: str) -> Job:
+    """Parse `script.py[:PRIORITY] [ARG ...]`."""
+    script, *args = shlex.split(spec)
+    priority = 0
+    name, _, suffix = script.rpartition(":")
+    if name and suffix.lstrip("-").isdigit():
+        script, priority = name, int(suffix)
+    return Job(script, priority, tuple(args))
+
+
+def install_job_context() -> None:
+    """Let every job see its own arguments and priority, including in the
+    worker threads it starts through an executor."""
+    submit = ThreadPoolExecutor.submit
+    parse_known_args = argparse.ArgumentParser.parse_known_args
+
+    def submit_in_context(executor, fn, /, *args, **kwargs):
+        context = contextvars.copy_context()
+        return submit(executor, context.run, fn, *args, **kwargs)
+
+    def parse_job_args(parser, args=None, namespace=None):
+        if args is None:
+            args = job_argv.get()
+        return parse_known_args(parser, args, namespace)
+
+    ThreadPoolExecutor.submit = submit_in_context  # type: ignore[assignment]
+    argparse.ArgumentParser.parse_known_args = (  # type: ignore[assignment]
+        parse_job_args
+    )
+
+
+def run_job(
+    index: int, job: Job, results: Dict[int, Tuple[str, float]]
+) -> None:
+    """Run a job's script as `__main__` and record how it ended."""
+    request_priority.set(job.priority)
+    job_argv.set(list(job.args))
+    path = os.path.join(SCRIPTS_DIR, job.script)
+    started = time.monotonic()
+    status = "ok"
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except SystemExit as exit_error:
+        if exit_error.code not in (None, 0):
+            status = f"exited with {exit_error.code}"
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        traceback.print_exc()
+        status = f"failed: {error!r}"
+    results[index] = (status, time.monotonic() - started)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the jobs and print a summary; returns 1 if any job failed."""
+    parser = argparse.ArgumentParser(
+        description="Run admin scripts with a shared request budget."
+    )
+    parser.add_argument(
+        "jobs", nargs="+", metavar="JOB", help="script.py[:PRIORITY] [ARG ...]"
+    )
+    jobs = [parse_job(spec) for spec in parser.parse_args(argv).jobs]
+
+    RequestBudget().install()
+    install_job_context()
+
+    results: Dict[int, Tuple[str, float]] = {}
+    threads = [
+        threading.Thread(
+            target=run_job, args=(index, job, results), name=job.script
+        )
+        for index, job in enumerate(jobs)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f"{'job':<40}{'priority':>9}{'seconds':>10}  status")
+    failed = 0
+    for index, job in enumerate(jobs):
+        status, elapsed = results.get(index, ("did not finish", 0.0))
+        command = " ".join([job.script, *job.args])
+        print(f"{command:<40}{job.priority:>9}{elapsed:>10.1f}  {status}")
+        failed += status != "ok"
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+JSON decoding helpers shared by the export scripts.
+
+`orjson` is used to decode whole responses when it is installed, and `ijson`
+is used to parse large pages incrementally, so that the items of an array
+such as `data[]` can be processed one at a time instead of materialising the
+whole page first. Both are optional; without them the standard library
+`json` module is used.
+"""
+
+import json
+from typing import Any, Dict, Iterator, Optional, Union
+
+import requests
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import ijson  # type: ignore
+except ImportError:  # pragma: no cover - optional dependency
+    ijson = None
+
+_CONTAINER_START = ("start_map", "start_array")
+_CONTAINER_END = ("end_map", "end_array")
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Decode a JSON document with the fastest available decoder."""
+    if orjson is not None:
+        return orjson.loads(data)  # pylint: disable=no-member
+    return json.loads(data)
+
+
+def decode(response: requests.Response) -> Any:
+    """Decode the body of a response, like `response.json()`."""
+    return loads(response.content)
+
+
+def iter_array(
+    response: requests.Response,
+    key: str,
+    envelope: Optional[Dict[str, Any]] = None,
+) -> Iterator[Any]:
+    """Yield the items of the top-level `key` array of a response one by one.
+
+    The other top-level members of the document, such as `links`, are stored
+    in `envelope` as they are parsed, so they are complete once the iterator
+    is exhausted. The response should be requested with `stream=True` for the
+    body to be parsed incrementally; this needs `ijson`, and without it the
+    whole body is decoded first.
+
+    The body is read through `Response.iter_content`, so a body that breaks
+    off raises the same `requests` exceptions as any failed request and can
+    be retried like one. A body that is not valid JSON raises a `ValueError`.
+    """
+    if envelope is None:
+        envelope = {}
+    if ijson is None or response.raw is None:
+        document = decode(response)
+        envelope.update(
+            (name, value) for name, value in document.items() if name != key
+        )
+        yield from document.get(key, [])
+        return
+
+    try:
+        yield from _iter_stream(_ContentReader(response), key, envelope)
+    except ijson.JSONError as error:
+        raise ValueError(f"Invalid JSON in the {key} page: {error}") from error
+    finally:
+        response.close()
+
+
+class _ContentReader:  # pylint: disable=too-few-public-methods
+    """A file-like view of a streamed response body, for `ijson`."""
+
+    def __init__(self, response: requests.Response) -> None:
+        self._chunks = response.iter_content(STREAM_CHUNK_SIZE)
+        self._buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        """Return up to `size` bytes, and nothing only at the end."""
+        if not self._buffer:
+            self._buffer = next(self._chunks, b"")
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _iter_stream(stream, key: str, envelope: Dict[str, Any]) -> Iterator[Any]:
+    """Parse a JSON object from a stream, yielding the items of `key`."""
+    item_prefix = f"{key}.item"
+    builder = None
+    target = ""
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == target and event in _CONTAINER_END:
+                if target == item_prefix:
+                    yield builder.value
+                else:
+                    envelope[target] = builder.value
+                builder = None
+            continue
+
+        if prefix in ("", key):
+            # The document itself, its keys, and the bounds of the array
+            continue
+        if event in _CONTAINER_START:
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            target = prefix
+        elif prefix == item_prefix:
+            yield value
+        else:
+            envelope[prefix] = value
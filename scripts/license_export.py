@@ -2,6 +2,14 @@
 This module exports managed accounts data from the Atlassian API to a CSV file.
 It includes functions to fetch data from the API, process accounts, and write
 the data to a CSV file.
+
+By default only the products on `JIRA_URL_WITHOUT_HTTPS` are exported. Set
+`JIRA_SITES` to a comma-separated list of site hosts, or to `*` for every
+site, to export several sites from a single pass over the organisation's
+users; each row carries its site in `product_url`. The number of active
+users per site is written to `license_site_counts.csv`, along with how many
+of them have the account-level `access_billable` flag set; the admin API
+does not say which sites a user is billed for.
 """
 
 import csv
@@ -11,13 +19,16 @@ import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from queue import Queue
-from typing import Any, Dict, Optional, Set, Tuple
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
 from urllib.parse import parse_qs, urlparse
 
 import requests
 from ratelimit import limits, sleep_and_retry  # type: ignore
 from unidecode import unidecode
 
+import json_backend
+from external_sort import sort_csv
+
 # Check if the .env var exists and load the environment variables
 env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
 if os.path.exists(env_path):
@@ -30,8 +41,14 @@ if os.path.exists(env_path):
 ORG_ID = os.environ.get("ORG_ID")
 ACCESS_TOKEN = os.environ.get("ACCESS_TOKEN")
 JIRA_URL_WITHOUT_HTTPS = os.environ.get("JIRA_URL_WITHOUT_HTTPS")
+# Comma-separated site hosts to export, or "*" for every site
+JIRA_SITES = os.environ.get("JIRA_SITES")
 OUTPUT_FILE = "managed_accounts.csv"
+COUNTS_FILE = "license_site_counts.csv"
 MAX_WORKERS = 5
+# Set SORT_OUTPUT=true to write the rows in a stable order
+SORT_OUTPUT = os.environ.get("SORT_OUTPUT", "").lower() in ("1", "true", "yes")
+SORT_COLUMNS = ["account_id", "product_url", "product_access_key"]
 
 
 # Rate limit decorator
@@ -39,12 +56,14 @@ MAX_WORKERS = 5
 @limits(calls=500, period=300)  # 500 calls per 300 seconds (5 minutes)
 def make_request(
     url: str, headers: Dict[str, str], params: Optional[Dict[str, str]] = None
-) -> Dict[str, Any]:
-    """Make a GET request to the given URL with the provided headers and
-    parameters."""
-    response = requests.get(url, headers=headers, params=params, timeout=10)
+) -> requests.Response:
+    """Make a streamed GET request to the given URL with the provided headers
+    and parameters."""
+    response = requests.get(
+        url, headers=headers, params=params, timeout=10, stream=True
+    )
     response.raise_for_status()
-    return response.json()
+    return response
 
 
 def writer_worker(output_file: str, queue: Queue) -> None:
@@ -74,8 +93,18 @@ def writer_worker(output_file: str, queue: Queue) -> None:
             queue.task_done()
 
 
-def process_account(account, queue, seen_combinations, jira_url_without_https):
-    """Process an individual account and add valid rows to the queue."""
+def export_sites() -> Optional[Set[str]]:
+    """Return the site hosts to export, or None to export every site."""
+    if not JIRA_SITES:
+        return {JIRA_URL_WITHOUT_HTTPS} if JIRA_URL_WITHOUT_HTTPS else set()
+    if JIRA_SITES.strip() == "*":
+        return None
+    return {site.strip() for site in JIRA_SITES.split(",") if site.strip()}
+
+
+def process_account(account, queue, seen_combinations, sites):
+    """Process an individual account and add the rows of the products on
+    `sites` (every site if None) to the queue."""
     if account.get("account_status") != "active":
         print(f"Skipping inactive account: {account}")
         return
@@ -84,11 +113,11 @@ def process_account(account, queue, seen_combinations, jira_url_without_https):
     for product in account["product_access"]:
         print(f"Processing product: {product}")
         product_url = unidecode(product.get("url", ""))
-        if product_url != jira_url_without_https:
+        if sites is not None and product_url not in sites:
             print(f"Skipping product URL: {product_url}")
             continue
 
-        combination = (account["account_id"], product["key"])
+        combination = (account["account_id"], product_url, product["key"])
         if combination in seen_combinations:
             print(f"Skipping duplicate combination: {combination}")
             continue
@@ -113,17 +142,22 @@ def process_account(account, queue, seen_combinations, jira_url_without_https):
 
 def add_row_to_queue(queue, row):
     """Add a row to the queue, handling duplicates and comparing dates."""
-    existing_row = next(
-        (
-            r
-            for r in queue.queue
-            if r["account_id"] == row["account_id"]
-            and r["product_access_key"] == row["product_access_key"]
-        ),
-        None,
-    )
-    if existing_row:
-        if (
+    # The writer thread pops from the queue concurrently, so look for a
+    # duplicate under the queue's lock
+    with queue.mutex:
+        existing_row = next(
+            (
+                r
+                for r in queue.queue
+                if r["account_id"] == row["account_id"]
+                and r["product_url"] == row["product_url"]
+                and r["product_access_key"] == row["product_access_key"]
+            ),
+            None,
+        )
+        if existing_row is None:
+            replace = True
+        elif (
             row["product_access_last_active"]
             and existing_row["product_access_last_active"]
         ):
@@ -133,39 +167,40 @@ def add_row_to_queue(queue, row):
             existing_date = datetime.strptime(
                 existing_row["product_access_last_active"], "%Y-%m-%dT%H:%M:%S.%fZ"
             )
-            if row_date > existing_date:
-                queue.queue.remove(existing_row)
-                queue.put(row)
+            replace = row_date > existing_date
         else:
-            if random.random() < 0.5:
-                queue.queue.remove(existing_row)
-                queue.put(row)
-    else:
+            replace = random.random() < 0.5
+        if existing_row is not None and replace:
+            queue.queue.remove(existing_row)
+    if replace:
         queue.put(row)
 
 
-def fetch_page_data(url, headers, cursor):
-    """Fetch a page of data from the API."""
+def fetch_page_data(
+    url, headers, cursor, page_envelope: Dict[str, Any]
+) -> Iterator[Dict[str, Any]]:
+    """Fetch a page of data from the API.
+
+    Returns an iterator that parses the page's accounts one at a time. The
+    rest of the page (such as `links`) is stored in `page_envelope` once the
+    iterator has been consumed.
+    """
     params = {"cursor": cursor} if cursor else None
-    response_data = make_request(url, headers, params)
-    if not isinstance(response_data, dict):
-        raise ValueError("Expected response_data to be a dictionary")
-    return response_data
+    response = make_request(url, headers, params)
+    return json_backend.iter_array(response, "data", page_envelope)
 
 
-def process_response_data(
-    response_data, executor, queue, seen_combinations, jira_url_without_https
-):
-    """Process the response data and submit tasks to the executor."""
+def process_response_data(accounts, executor, queue, seen_combinations, sites):
+    """Process the page's accounts and submit tasks to the executor."""
     futures = []
-    for account in response_data["data"]:
+    for account in accounts:
         futures.append(
             executor.submit(
                 process_account,
                 account,
                 queue,
                 seen_combinations,
-                jira_url_without_https,
+                sites,
             )
         )
     return futures
@@ -180,17 +215,30 @@ def update_cursor(response_data):
     return parse_qs(parsed_url.query)["cursor"][0]
 
 
+def org_headers(access_token: str) -> Dict[str, str]:
+    """Return the headers for the organisation admin API."""
+    return {
+        "Accept": "application/json",
+        "Authorization": f"Bearer {access_token}",
+    }
+
+
 def get_managed_accounts(
-    org_id: str, access_token: str, output_file: str, max_workers: int = 5
+    org_id: str,
+    access_token: str,
+    output_file: str,
+    max_workers: int = 5,
+    *,
+    sites: Optional[Set[str]],
 ) -> None:
-    """Fetch managed accounts from Atlassian API and write to a CSV file."""
+    """Fetch managed accounts from Atlassian API and write the products on
+    `sites` (every site if None) to a CSV file."""
     if not org_id or not access_token or not output_file:
         raise ValueError(
             "org_id, access_token, output_file must be provided and not None."
         )
 
     url = f"https://api.atlassian.com/admin/v1/orgs/{org_id}/users"
-    headers = {"Accept": "application/json", "Authorization": f"Bearer {access_token}"}
 
     queue: Queue = Queue()
     writer_thread = threading.Thread(target=writer_worker, args=(output_file, queue))
@@ -198,31 +246,31 @@ def get_managed_accounts(
 
     cursor = None
     page_count = 1
-    # Track seen account_id and product_access_key combinations
-    seen_combinations: Set[Tuple[str, str]] = set()
+    # Track seen account_id, product_url and product_access_key combinations
+    seen_combinations: Set[Tuple[str, str, str]] = set()
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         while True:
             print(f"Fetching page {page_count}...")
-            response_data = fetch_page_data(url, headers, cursor)
-
-            if "data" not in response_data:
-                print("No more data found. Exiting.")
-                break
+            page_envelope: Dict[str, Any] = {}
 
             futures = process_response_data(
-                response_data,
+                fetch_page_data(url, org_headers(access_token), cursor, page_envelope),
                 executor,
                 queue,
                 seen_combinations,
-                JIRA_URL_WITHOUT_HTTPS,
+                sites,
             )
 
+            if not futures:
+                print("No more data found. Exiting.")
+                break
+
             # Wait for all the processing tasks to complete
             for future in as_completed(futures):
                 future.result()
 
-            cursor = update_cursor(response_data)
+            cursor = update_cursor(page_envelope)
             if cursor is None:
                 print("Reached the end of the pages.")
                 break
@@ -236,7 +284,47 @@ def get_managed_accounts(
     print(f"Data exported to {output_file} successfully.")
 
 
-if ORG_ID and ACCESS_TOKEN and OUTPUT_FILE:
-    get_managed_accounts(ORG_ID, ACCESS_TOKEN, OUTPUT_FILE, MAX_WORKERS)
-else:
-    print("Please provide valid ORG_ID, ACCESS_TOKEN, and OUTPUT_FILE.")
+def write_site_counts(output_file: str, counts_file: str) -> None:
+    """Count the distinct active users of each site in the export, and those
+    of them whose account has `access_billable` set, and write them to
+    `counts_file`. The flag is per account, so a user billed for one site
+    is counted under every site they can access."""
+    users: Dict[str, Set[str]] = {}
+    billable: Dict[str, Set[str]] = {}
+    with open(output_file, newline="", encoding="utf-8") as csvfile:
+        for row in csv.DictReader(csvfile):
+            site = row["product_url"]
+            users.setdefault(site, set()).add(row["account_id"])
+            if row["access_billable"] == "True":
+                billable.setdefault(site, set()).add(row["account_id"])
+
+    with open(counts_file, "w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["product_url", "active_users", "access_billable_users"])
+        for site in sorted(users):
+            writer.writerow(
+                [site, len(users[site]), len(billable.get(site, ()))]
+            )
+    print(f"Per-site counts for {len(users)} sites written to {counts_file}.")
+
+
+def main() -> None:
+    """Export the managed accounts, optionally sorting the output."""
+    if not (ORG_ID and ACCESS_TOKEN and OUTPUT_FILE):
+        print("Please provide valid ORG_ID, ACCESS_TOKEN, and OUTPUT_FILE.")
+        return
+    sites = export_sites()
+    if sites is not None and not sites:
+        print("Please provide JIRA_URL_WITHOUT_HTTPS or JIRA_SITES.")
+        return
+    get_managed_accounts(
+        ORG_ID, ACCESS_TOKEN, OUTPUT_FILE, MAX_WORKERS, sites=sites
+    )
+    if SORT_OUTPUT:
+        sort_csv([OUTPUT_FILE], OUTPUT_FILE, SORT_COLUMNS)
+        print(f"Sorted {OUTPUT_FILE} by {', '.join(SORT_COLUMNS)}.")
+    write_site_counts(OUTPUT_FILE, COUNTS_FILE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+Offboards a list of leavers in one run, instead of running
+`remove_users_from_group.py`, `atlassian_access_disable.py` and
+`atlassian_deactivate.py` one after the other.
+
+The leavers file lists one email address or account ID per row. Identities
+are resolved once, from the organisation's managed-user directory and the
+member lists of the groups, with a user search only for the emails found in
+neither. A search result only counts if its email address is exactly the
+one searched for, and anything else is reported as not found. Every user
+then goes through three dependent stages:
+
+1. removal from the groups they are a member of,
+2. removal of their Atlassian access,
+3. deactivation in the organisation's directory.
+
+Each stage has its own thread pool and a user moves on to the next stage as
+soon as their previous one is done, so users go through the pipeline
+independently and the run takes about as long as its slowest stage. Stages
+that would be no-ops are skipped, a user whose stage fails for good does not
+go on to the next one, and the outcome of every stage is written to
+`offboarding_report.csv`. Run it with `--dry-run` to only write the plan.
+"""
+
+import argparse
+import csv
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import atlassian_access_disable
+import atlassian_deactivate
+import remove_users_from_group
+from adaptive_concurrency import AdaptiveExecutor
+from directory_snapshot import fetch_directory
+from export_users_from_group import fetch_group_members
+from retry_queue import RetryQueue
+
+# Check if the .env var exists and load the environment variables
+env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
+if os.path.exists(env_path):
+    with open(env_path, encoding="utf-8") as file:
+        for line in file:
+            key, value = line.strip().split("=", 1)
+            os.environ[key] = value
+
+ORG_ID = os.environ.get("ORG_ID")
+ACCESS_TOKEN = os.environ.get("ACCESS_TOKEN")
+REMOVAL_GROUP_NAME = os.environ.get("REMOVAL_GROUP_NAME")
+INPUT_FILE = "leavers.csv"
+REPORT_FILE = "offboarding_report.csv"
+STAGES = ["groups", "access", "deactivation"]
+# The access and deactivation stages call the admin API, which is rate
+# limited per organisation rather than slowed down by load. Their requests
+# carry no limiter hook, so there is no latency to adapt to and their pools
+# stay small and fixed
+ADMIN_STAGE_WORKERS = 5
+
+# Stages that fail are replayed once the pipeline has drained
+retry_queue = RetryQueue()
+
+
+def look_up_emails(emails):
+    """Search for the account IDs of emails, returning the ones found."""
+    # The lookups are observed by the group stage's limiter, so let it size
+    # them as well
+    with AdaptiveExecutor(remove_users_from_group.limiter) as executor:
+        looked_up = list(
+            executor.map(
+                lambda email: retry_queue.call(
+                    f"account ID lookup for {email}",
+                    remove_users_from_group.lookup_account_id, email,
+                    default=(email, None),
+                ),
+                emails,
+            )
+        )
+    looked_up += [result for _, result in retry_queue.replay()]
+    return {email: account_id for email, account_id in looked_up if account_id}
+
+
+def groups_by_account(members_by_group):
+    """Return the groups of each member, keyed by account ID."""
+    groups = {}
+    for group_name, members in members_by_group.items():
+        for member in members:
+            groups.setdefault(member["accountId"], []).append(group_name)
+    return groups
+
+
+def resolve_users(entries, directory, members_by_group):
+    """Resolve the leavers file entries to users.
+
+    Emails are matched against the directory and the group member lists
+    first, and searched for only if neither has them. Returns the users,
+    one per account ID, and the entries that could not be resolved.
+    """
+    emails, account_ids = entries
+    ids_by_email = {
+        member["emailAddress"].lower(): member["accountId"]
+        for members in members_by_group.values()
+        for member in members
+        if member.get("emailAddress")
+    }
+    ids_by_email.update(
+        (account["email"].lower(), account_id)
+        for account_id, account in directory.items()
+        if account["email"]
+    )
+    resolved = {
+        email: ids_by_email[email] for email in emails if email in ids_by_email
+    }
+    to_look_up = sorted(emails - resolved.keys())
+    print(
+        f"Resolved {len(resolved)} emails from the directory and groups, "
+        f"searching for {len(to_look_up)}"
+    )
+    resolved.update(look_up_emails(to_look_up))
+    unresolved = sorted(emails - resolved.keys())
+    # Account IDs in the leavers file stand for themselves
+    resolved.update((account_id, account_id) for account_id in account_ids)
+
+    groups_by_id = groups_by_account(members_by_group)
+    users = {}
+    for entry, account_id in sorted(resolved.items()):
+        users.setdefault(
+            account_id,
+            {
+                "entry": entry,
+                "account_id": account_id,
+                "groups": groups_by_id.get(account_id, []),
+                "outcomes": {},
+            },
+        )
+    return list(users.values()), unresolved
+
+
+def skip_reason(stage, user, directory):
+    """Why a stage would be a no-op for a user, or None if it is needed."""
+    if stage == "groups":
+        return None if user["groups"] else "not a member"
+    account = directory.get(user["account_id"])
+    if account is None:
+        return "not managed by the organisation"
+    noop_statuses = (
+        atlassian_access_disable.NOOP_STATUSES
+        if stage == "access"
+        else atlassian_deactivate.NOOP_STATUSES
+    )
+    if account["account_status"] in noop_statuses:
+        return f"already {account['account_status']}"
+    return None
+
+
+def remove_from_groups(user):
+    """Remove a user from each of their groups, forgetting each group once
+    the user is out of it so that a replay continues where it stopped."""
+    while user["groups"]:
+        remove_users_from_group.remove_user_from_group(
+            user["account_id"], user["groups"][0]
+        )
+        user["groups"].pop(0)
+
+
+def remove_access(user):
+    """Remove a user's Atlassian access."""
+    atlassian_access_disable.remove_user_access(user["account_id"], ACCESS_TOKEN)
+
+
+def deactivate(user):
+    """Deactivate a user in the organisation's directory."""
+    atlassian_deactivate.delete_atlassian_user(user["account_id"])
+
+
+STAGE_ACTIONS = {
+    "groups": remove_from_groups,
+    "access": remove_access,
+    "deactivation": deactivate,
+}
+
+
+class Pipeline:
+    """Moves users through the stages, each stage on its own executor."""
+
+    def __init__(self, directory, executors):
+        self.directory = directory
+        self.executors = executors
+        self._pending = 0
+        self._condition = threading.Condition()
+
+    def start(self, user):
+        """Send a user into the first stage."""
+        self._submit(0, user)
+
+    def _submit(self, index, user):
+        with self._condition:
+            self._pending += 1
+        self.executors[index].submit(self._run, index, user)
+
+    def _run(self, index, user):
+        try:
+            retry_queue.call(
+                f"{STAGES[index]} stage for {user['entry']}",
+                self.advance, index, user,
+            )
+        finally:
+            with self._condition:
+                self._pending -= 1
+                self._condition.notify_all()
+
+    def advance(self, index, user):
+        """Run a user's stage and, if it succeeds, send them on to the next
+        one."""
+        stage = STAGES[index]
+        try:
+            reason = skip_reason(stage, user, self.directory)
+            if reason:
+                user["outcomes"][stage] = f"skipped ({reason})"
+            else:
+                STAGE_ACTIONS[stage](user)
+                user["outcomes"][stage] = "done"
+        except requests.RequestException as error:
+            user["outcomes"][stage] = f"failed ({error})"
+            raise
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            # Anything else would vanish into the executor's future, so it is
+            # reported here and recorded as failed without a retry
+            traceback.print_exc()
+            user["outcomes"][stage] = f"failed ({error!r})"
+            retry_queue.add(
+                f"{stage} stage for {user['entry']}", self.advance, (index, user), error
+            )
+            return
+        if index + 1 < len(STAGES):
+            self._submit(index + 1, user)
+
+    def wait(self):
+        """Wait until no user is in a stage any more."""
+        with self._condition:
+            while self._pending:
+                self._condition.wait()
+
+    def close(self):
+        """Shut the stage executors down, first stage first."""
+        for executor in self.executors:
+            executor.shutdown()
+
+
+def run_pipeline(users, directory):
+    """Run every user through the stages, replaying failed stages once the
+    pipeline has drained."""
+    pipeline = Pipeline(
+        directory,
+        [
+            AdaptiveExecutor(remove_users_from_group.limiter),
+            ThreadPoolExecutor(max_workers=ADMIN_STAGE_WORKERS),
+            ThreadPoolExecutor(max_workers=ADMIN_STAGE_WORKERS),
+        ],
+    )
+    try:
+        for user in users:
+            pipeline.start(user)
+        pipeline.wait()
+        # Replayed stages send their users on, so drain again after each
+        while retry_queue:
+            retry_queue.replay()
+            pipeline.wait()
+    finally:
+        pipeline.close()
+
+
+def plan_users(users, directory):
+    """Record what each stage would do, without changing anything."""
+    for user in users:
+        for stage in STAGES:
+            reason = skip_reason(stage, user, directory)
+            user["outcomes"][stage] = f"skipped ({reason})" if reason else "planned"
+
+
+def write_report(users, unresolved, report_file):
+    """Write the outcome of every stage for every leaver."""
+    with open(report_file, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Entry", "Account ID", *STAGES])
+        for user in users:
+            writer.writerow(
+                [
+                    user["entry"],
+                    user["account_id"],
+                    *(user["outcomes"].get(stage, "not reached") for stage in STAGES),
+                ]
+            )
+        for entry in unresolved:
+            writer.writerow([entry, "", *("account not found" for _ in STAGES)])
+    print(f"Report written to {report_file}")
+
+
+def main():
+    """Resolve the leavers and run them through the offboarding stages."""
+    parser = argparse.ArgumentParser(description="Offboard a list of leavers.")
+    parser.add_argument(
+        "--input", default=INPUT_FILE, help="emails or account IDs, one per row"
+    )
+    parser.add_argument(
+        "--groups",
+        nargs="+",
+        metavar="NAME",
+        default=[REMOVAL_GROUP_NAME] if REMOVAL_GROUP_NAME else [],
+        help="groups to remove the leavers from (defaults to REMOVAL_GROUP_NAME)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only write the plan to the report"
+    )
+    args = parser.parse_args()
+    if not (ORG_ID and ACCESS_TOKEN):
+        parser.error("ORG_ID and ACCESS_TOKEN must be set")
+
+    entries = remove_users_from_group.read_desired_members(args.input)
+    directory = fetch_directory(ORG_ID, ACCESS_TOKEN)
+    members_by_group = {
+        group_name: fetch_group_members(group_name) for group_name in args.groups
+    }
+    users, unresolved = resolve_users(entries, directory, members_by_group)
+    print(f"Offboarding {len(users)} users, {len(unresolved)} could not be found")
+
+    if args.dry_run:
+        plan_users(users, directory)
+    else:
+        run_pipeline(users, directory)
+    write_report(users, unresolved, REPORT_FILE)
+    retry_queue.report()
+
+
+if __name__ == "__main__":
+    main()
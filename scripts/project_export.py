@@ -4,6 +4,8 @@ import os
 import requests
 from requests.auth import HTTPBasicAuth
 
+import json_backend
+
 # Check if the .env var exists and load the environment variables
 env_path = os.path.join(os.path.dirname(__file__), ".", ".env")
 if os.path.exists(env_path):
@@ -27,7 +29,7 @@ response = requests.get(
 )
 
 # Parse the response as JSON
-projects = response.json()
+projects = json_backend.decode(response)
 
 # Create or open a CSV file named 'jira_projects.csv' in write mode
 with open("jira_projects.csv", "w", newline="", encoding="utf-8") as file:
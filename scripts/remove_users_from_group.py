@@ -1,15 +1,26 @@
 """
 Jira Cloud REST API example using Python 3 demonstrating how to remove users
 from a Jira group using a CSV file containing email addresses.
+
+With `--sync desired.csv`, the group is instead reconciled with a desired
+membership list of email addresses or account IDs, one per row. The current
+members are fetched once, the minimal set of additions and removals is
+computed locally, and only those changes are applied. `--dry-run` prints
+the plan without changing anything.
 """
 
+import argparse
 import csv
-from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import requests
 from requests.auth import HTTPBasicAuth
 
+import json_backend
+from adaptive_concurrency import AdaptiveExecutor, AdaptiveLimiter
+from export_users_from_group import fetch_group_members
+from retry_queue import RetryQueue
+
 logging.basicConfig(level=logging.INFO)
 
 
@@ -36,13 +47,26 @@ HEADERS = {
 }
 AUTH = HTTPBasicAuth(USER_EMAIL, API_TOKEN)
 REMOVAL_GROUP_NAME = os.environ.get("REMOVAL_GROUP_NAME")
+SYNC_GROUP_NAME = os.environ.get("SYNC_GROUP_NAME", REMOVAL_GROUP_NAME)
+GROUP_USER_ENDPOINT = f"{JIRA_URL}/rest/api/3/group/user"
 CSV_FILE = "users.csv"
-NUM_WORKERS = 10
+# Upper bound on the requests sent at once; the limiter finds the actual value
+NUM_WORKERS = 50
+
+# Requests that fail are replayed once each pass has finished
+retry_queue = RetryQueue()
+
+# Requests sent at once, adjusted to how the instance responds
+limiter = AdaptiveLimiter(initial=5, max_limit=NUM_WORKERS)
+HOOKS = {"response": limiter.observe}
 
 
 def get_account_id(email):
     """
     Fetches the account ID for the given email address.
+
+    The user search matches name and email prefixes, so only a user whose
+    email address is exactly the one searched for is accepted.
     """
     logging.debug("Fetching account ID for email: %s", email)
 
@@ -50,7 +74,8 @@ def get_account_id(email):
     params = {"query": email}
 
     response = requests.get(
-        endpoint, headers=HEADERS, params=params, auth=AUTH, timeout=30
+        endpoint, headers=HEADERS, params=params, auth=AUTH, timeout=30,
+        hooks=HOOKS,
     )
 
     if response.status_code != 200:
@@ -61,15 +86,26 @@ def get_account_id(email):
             response.status_code,
             response.text,
         )
+        response.raise_for_status()
         return None
 
     try:
-        users = response.json()
-        if not users:  # No user found matching the email
-            return None
-        user = users[0]
-    except (ValueError, IndexError):
-        logging.error("Failed to parse JSON response or user not found.")
+        users = json_backend.decode(response)
+    except ValueError:
+        logging.error("Failed to parse JSON response.")
+        return None
+    user = next(
+        (
+            user
+            for user in users
+            if (user.get("emailAddress") or "").lower() == email.lower()
+        ),
+        None,
+    )
+    if user is None:  # No user has exactly this email
+        logging.warning(
+            "No user with the email %s among %s search results", email, len(users)
+        )
         return None
 
     # Extract account ID based on the response structure
@@ -79,41 +115,240 @@ def get_account_id(email):
     return account_id
 
 
-def remove_user_from_group(account_id):
+def lookup_account_id(email):
+    """
+    Fetches the account ID for the given email address, returning it along
+    with the email address.
+    """
+    return email, get_account_id(email)
+
+
+def remove_user_from_group(account_id, group_name=REMOVAL_GROUP_NAME):
     """
     Removes a user from a Jira group.
     """
     logging.debug(
-        "Trying to remove account %s from group %s", account_id,
-        REMOVAL_GROUP_NAME
-    )
-    endpoint = (
-        f"{JIRA_URL}/rest/api/3/group/user?groupname={REMOVAL_GROUP_NAME}&"
-        f"accountId={account_id}"
+        "Trying to remove account %s from group %s", account_id, group_name
     )
     response = requests.delete(
-        endpoint, headers=HEADERS, auth=AUTH, timeout=30
+        GROUP_USER_ENDPOINT,
+        headers=HEADERS,
+        params={"groupname": group_name, "accountId": account_id},
+        auth=AUTH,
+        timeout=30,
+        hooks=HOOKS,
     )
     if response.status_code == 200:
         logging.info(
             "Successfully removed user %s from group %s.",
             account_id,
-            REMOVAL_GROUP_NAME,
+            group_name,
         )
     else:
         logging.error(
             "Failed to remove user %s from group %s. Response: %s, Status: %s",
             account_id,
-            REMOVAL_GROUP_NAME,
+            group_name,
             response.text,
             response.status_code
         )
+        response.raise_for_status()
+
+
+def add_user_to_group(account_id, group_name):
+    """
+    Adds a user to a Jira group.
+    """
+    logging.debug("Trying to add account %s to group %s", account_id, group_name)
+    response = requests.post(
+        GROUP_USER_ENDPOINT,
+        headers=HEADERS,
+        params={"groupname": group_name},
+        json={"accountId": account_id},
+        auth=AUTH,
+        timeout=30,
+        hooks=HOOKS,
+    )
+    if response.status_code == 201:
+        logging.info("Successfully added user %s to group %s.", account_id, group_name)
+    else:
+        logging.error(
+            "Failed to add user %s to group %s. Response: %s, Status: %s",
+            account_id,
+            group_name,
+            response.text,
+            response.status_code
+        )
+        response.raise_for_status()
+
+
+def read_desired_members(file_path):
+    """
+    Reads the desired members of a group, one email address or account ID
+    per row, and returns them as separate sets.
+    """
+    emails, account_ids = set(), set()
+    with open(file_path, mode="r", encoding="utf-8") as file:
+        for row in csv.reader(file):
+            if not row or not row[0].strip():
+                continue
+            entry = row[0].strip()
+            if "@" in entry:
+                emails.add(entry.lower())
+            else:
+                account_ids.add(entry)
+    return emails, account_ids
+
+
+def resolve_desired_members(emails, account_ids, members, executor):
+    """
+    Resolves the desired emails to account IDs, using the emails visible in
+    the current member list first and a user search only for the rest.
+
+    Returns the desired account IDs, the emails that could not be resolved
+    because a lookup failed and the emails no user was found for.
+    """
+    desired = set(account_ids)
+    member_ids_by_email = {
+        member["emailAddress"].lower(): member["accountId"]
+        for member in members
+        if member.get("emailAddress")
+    }
+    to_look_up = []
+    for email in sorted(emails):
+        if email in member_ids_by_email:
+            desired.add(member_ids_by_email[email])
+        else:
+            to_look_up.append(email)
+    logging.info(
+        "Matched %s emails against the member list, looking up %s",
+        len(emails) - len(to_look_up),
+        len(to_look_up),
+    )
+
+    failed_lookups, not_found = [], []
+    looked_up = executor.map(
+        lambda email: retry_queue.call(
+            f"account ID lookup for {email}", lookup_account_id, email,
+            default=(email, False),
+        ),
+        to_look_up,
+    )
+    for email, account_id in looked_up:
+        if account_id is False:
+            # The lookup was deferred to the retry queue
+            failed_lookups.append(email)
+        elif account_id:
+            desired.add(account_id)
+        else:
+            logging.warning("No account found for %s, it cannot be added", email)
+            not_found.append(email)
+    for _, (email, account_id) in retry_queue.replay():
+        failed_lookups.remove(email)
+        if account_id:
+            desired.add(account_id)
+        else:
+            not_found.append(email)
+    return desired, failed_lookups, not_found
+
+
+def sync_group(group_name, file_path, dry_run=False):
+    """
+    Reconciles the members of a group with the desired membership file by
+    applying only the additions and removals that are needed.
+    """
+    emails, account_ids = read_desired_members(file_path)
+    logging.info(
+        "Loaded %s emails and %s account IDs from %s",
+        len(emails), len(account_ids), file_path,
+    )
+    members = fetch_group_members(group_name)
+    current = {member["accountId"] for member in members}
+    logging.info("Group %s has %s members", group_name, len(current))
+
+    with AdaptiveExecutor(limiter) as executor:
+        desired, failed_lookups, not_found = resolve_desired_members(
+            emails, account_ids, members, executor
+        )
+        to_add = sorted(desired - current)
+        to_remove = sorted(current - desired)
+        if not_found:
+            # A member whose email is hidden may be one of the emails that
+            # were not found, so only members with a visible email are removed
+            hidden = {
+                member["accountId"]
+                for member in members
+                if not member.get("emailAddress")
+            }
+            kept = [account_id for account_id in to_remove if account_id in hidden]
+            if kept:
+                logging.warning(
+                    "Keeping %s members with hidden emails, as %s desired "
+                    "emails were not found",
+                    len(kept),
+                    len(not_found),
+                )
+                to_remove = [
+                    account_id for account_id in to_remove if account_id not in hidden
+                ]
+        if failed_lookups:
+            # A member whose lookup failed would look like an extra member
+            logging.error(
+                "Could not look up %s emails, so no members will be removed: %s",
+                len(failed_lookups),
+                ", ".join(failed_lookups),
+            )
+            to_remove = []
+        logging.info(
+            "Sync plan for group %s: add %s, remove %s, keep %s",
+            group_name, len(to_add), len(to_remove),
+            len(current & desired),
+        )
+        if dry_run:
+            return
+
+        list(
+            executor.map(
+                lambda account_id: retry_queue.call(
+                    f"addition of {account_id}",
+                    add_user_to_group, account_id, group_name,
+                ),
+                to_add,
+            )
+        )
+        list(
+            executor.map(
+                lambda account_id: retry_queue.call(
+                    f"removal of {account_id}",
+                    remove_user_from_group, account_id, group_name,
+                ),
+                to_remove,
+            )
+        )
+        retry_queue.replay()
+    retry_queue.report()
+    limiter.report()
 
 
 def main():
     """
     Main function.
     """
+    parser = argparse.ArgumentParser(description="Remove or sync group members.")
+    parser.add_argument(
+        "--sync",
+        metavar="FILE",
+        help="reconcile SYNC_GROUP_NAME with the desired members in FILE",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="with --sync, only print the plan"
+    )
+    args = parser.parse_args()
+    if args.sync:
+        logging.info("Syncing group %s with %s", SYNC_GROUP_NAME, args.sync)
+        sync_group(SYNC_GROUP_NAME, args.sync, args.dry_run)
+        return
+
     logging.info("Starting the script")
     emails = []
 
@@ -123,13 +358,32 @@ def main():
         emails = [row[0] for row in reader]
     logging.info("Loaded %s emails from %s", len(emails), CSV_FILE)
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+    with AdaptiveExecutor(limiter) as executor:
         logging.info("Fetching account IDs from emails")
-        account_ids = list(executor.map(get_account_id, emails))
+        account_ids = list(
+            executor.map(
+                lambda email: retry_queue.call(
+                    f"account ID lookup for {email}", get_account_id, email
+                ),
+                emails,
+            )
+        )
+        account_ids += [result for _, result in retry_queue.replay()]
+        account_ids = [account_id for account_id in account_ids if account_id]
 
         logging.info("Removing users from Jira group")
-        list(executor.map(remove_user_from_group, account_ids))
-    logging.info("Script finished successfully")
+        list(
+            executor.map(
+                lambda account_id: retry_queue.call(
+                    f"removal of {account_id}", remove_user_from_group, account_id
+                ),
+                account_ids,
+            )
+        )
+        retry_queue.replay()
+    retry_queue.report()
+    limiter.report()
+    logging.info("Script finished")
 
 
 if __name__ == "__main__":
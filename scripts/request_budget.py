@@ -0,0 +1,169 @@
+"""
+Shared request budget for scripts that run in the same process.
+
+Every request sent through `requests` takes a token from the bucket of its
+host before it is sent, so `api.atlassian.com` and the Jira site are
+throttled separately, each to one budget however many jobs and threads are
+sending requests. When tokens run short, waiters with a higher priority are
+served first. A `429 Too Many Requests` response pauses the whole host for
+the `Retry-After` delay before the request is sent again, instead of every
+thread finding out on its own.
+
+The rates, in requests per second with an optional burst, are read from
+`REQUEST_BUDGET`, for example `api.atlassian.com=1.6/10,*=10/20`, where `*`
+applies to every other host.
+"""
+
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+# Requests per second and burst size; "*" applies to every other host
+DEFAULT_RATES: Dict[str, Tuple[float, float]] = {
+    "api.atlassian.com": (1.6, 10.0),
+    "*": (10.0, 20.0),
+}
+# Times a throttled request is sent again before its 429 is returned
+MAX_THROTTLE_RETRIES = 3
+# Pause used when a 429 response has no usable Retry-After header
+DEFAULT_THROTTLE_PAUSE = 5.0
+
+# The priority of the requests sent from the current context; higher first
+request_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "request_priority", default=0
+)
+# Orders waiters of the same priority first come, first served
+_waiter_sequence = itertools.count()
+
+
+class TokenBucket:
+    """A token bucket whose waiters are served in priority order."""
+
+    def __init__(self, rate: float, burst: float) -> None:
+        if rate <= 0 or burst < 1:
+            # A bucket that never holds a whole token would block forever
+            raise ValueError("The rate must be positive and the burst at least 1")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: List[Tuple[int, int]] = []
+        self._condition = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def acquire(self, priority: int = 0) -> None:
+        """Wait for a token, behind every waiter with a higher priority."""
+        with self._condition:
+            waiter = (-priority, next(_waiter_sequence))
+            heapq.heappush(self._waiters, waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    timeout: Optional[float] = None
+                    if self._waiters[0] == waiter:
+                        if now < self._paused_until:
+                            timeout = self._paused_until - now
+                        elif self._tokens >= 1:
+                            self._tokens -= 1
+                            return
+                        else:
+                            timeout = (1 - self._tokens) / self.rate
+                    self._condition.wait(timeout)
+            finally:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for `seconds`."""
+        with self._condition:
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + seconds
+            )
+            self._condition.notify_all()
+
+
+def parse_rates(spec: Optional[str]) -> Dict[str, Tuple[float, float]]:
+    """Parse `host=rate[/burst]` entries separated by commas on top of the
+    default rates.
+
+    The burst defaults to the rate, but is at least one request, as a
+    request needs a whole token.
+    """
+    rates = dict(DEFAULT_RATES)
+    for entry in (spec or "").split(","):
+        if not entry.strip():
+            continue
+        host, limit = entry.strip().split("=", 1)
+        rate, _, burst = limit.partition("/")
+        host_rate = float(rate)
+        host_burst = float(burst) if burst else max(host_rate, 1.0)
+        if host_rate <= 0 or host_burst < 1:
+            raise ValueError(
+                f"Invalid request budget {entry.strip()!r}: the rate must be "
+                "positive and the burst at least 1"
+            )
+        rates[host] = (host_rate, host_burst)
+    return rates
+
+
+def throttle_delay(response: requests.Response) -> float:
+    """The pause requested by a throttled response."""
+    try:
+        return float(response.headers.get("Retry-After", DEFAULT_THROTTLE_PAUSE))
+    except ValueError:
+        return DEFAULT_THROTTLE_PAUSE
+
+
+class RequestBudget:
+    """One token bucket per API host, shared by every request."""
+
+    def __init__(self, rates: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.rates = rates or parse_rates(os.environ.get("REQUEST_BUDGET"))
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket_for(self, url: str) -> TokenBucket:
+        """Return the bucket of the host of `url`."""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                rate, burst = self.rates.get(host, self.rates["*"])
+                self._buckets[host] = TokenBucket(rate, burst)
+            return self._buckets[host]
+
+    def install(self) -> None:
+        """Route every request sent through `requests` through the budget."""
+        send = requests.Session.request
+        budget = self
+
+        def budgeted_request(
+            session: requests.Session, method: str, url: str, *args: Any, **kwargs: Any
+        ) -> requests.Response:
+            bucket = budget.bucket_for(url)
+            for attempt in range(MAX_THROTTLE_RETRIES + 1):
+                bucket.acquire(request_priority.get())
+                response = send(session, method, url, *args, **kwargs)
+                if response.status_code != 429 or attempt == MAX_THROTTLE_RETRIES:
+                    break
+                delay = throttle_delay(response)
+                print(f"Throttled by {urlparse(url).netloc}, pausing {delay:.0f}s")
+                response.close()
+                bucket.pause(delay)
+            return response
+
+        requests.Session.request = budgeted_request  # type: ignore[assignment]
@@ -0,0 +1,136 @@
+"""
+Deferred retry queue shared by the scripts.
+
+Work items that fail with a transient error (a connection problem, a 429 or
+a 5xx response) during the main pass of a script are collected instead of
+being dropped. Once the main pass has finished they are replayed with
+exponential backoff and full jitter, and anything that still fails is
+listed in a final report, so that a few failed requests do not mean
+rerunning a whole export.
+"""
+
+import random
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+import requests
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether retrying the request that raised `error` might succeed."""
+    response = getattr(error, "response", None)
+    if isinstance(error, requests.HTTPError) and response is not None:
+        return response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, requests.RequestException)
+
+
+def retry_after(error: BaseException) -> float:
+    """The delay in seconds requested by a `Retry-After` header, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return 0.0
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0.0
+
+
+class RetryQueue:
+    """Collects failed work items and replays them after the main pass."""
+
+    def __init__(
+        self, max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failed: List[Tuple[str, BaseException]] = []
+        self._pending: List[Tuple[str, Callable[..., Any], tuple, BaseException]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def add(
+        self,
+        description: str,
+        func: Callable[..., Any],
+        args: tuple,
+        error: BaseException,
+    ) -> None:
+        """Queue `func(*args)` for replay, or record it as failed when the
+        error is not worth retrying."""
+        with self._lock:
+            if is_retryable(error):
+                self._pending.append((description, func, args, error))
+            else:
+                self.failed.append((description, error))
+
+    def call(
+        self,
+        description: str,
+        func: Callable[..., Any],
+        *args: Any,
+        default: Optional[Any] = None,
+    ) -> Any:
+        """Call `func(*args)`, deferring it to the queue if a request fails.
+
+        Returns the result of the call, or `default` if it was deferred.
+        """
+        try:
+            return func(*args)
+        except requests.RequestException as error:
+            action = "Deferring" if is_retryable(error) else "Giving up on"
+            print(f"{action} {description} after error: {error}")
+            self.add(description, func, args, error)
+            return default
+
+    def replay(self) -> List[Tuple[str, Any]]:
+        """Replay the queued items until they succeed or run out of attempts.
+
+        Returns the (description, result) pairs of the items that succeeded.
+        Items that still fail are moved to `failed`.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        results: List[Tuple[str, Any]] = []
+
+        for attempt in range(1, self.max_attempts + 1):
+            if not pending:
+                break
+            delay = random.uniform(
+                0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+            )
+            delay = max(delay, max(retry_after(item[3]) for item in pending))
+            print(
+                f"Retrying {len(pending)} failed items in {delay:.1f}s "
+                f"(attempt {attempt} of {self.max_attempts})"
+            )
+            time.sleep(delay)
+
+            still_pending = []
+            for description, func, args, _ in pending:
+                try:
+                    results.append((description, func(*args)))
+                except requests.RequestException as error:
+                    if is_retryable(error) and attempt < self.max_attempts:
+                        still_pending.append((description, func, args, error))
+                    else:
+                        with self._lock:
+                            self.failed.append((description, error))
+            pending = still_pending
+
+        return results
+
+    def report(self) -> None:
+        """Print the items that failed for good."""
+        if not self.failed:
+            print("Every item completed successfully.")
+            return
+        print(f"{len(self.failed)} items failed and could not be recovered:")
+        for description, error in self.failed:
+            print(f"  {description}: {error}")
@@ -0,0 +1,141 @@
+"""
+Tests for `jira_service_management_audit.py`: incremental changelog fetches
+from a watermark, the JQL built for incremental runs and time shards, and
+the pruning of the incremental state. No network access is needed.
+
+    python -m unittest test_jira_service_management_audit
+"""
+
+import os
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+# The module reads its configuration on import
+os.environ.setdefault("JIRA_URL", "https://example.atlassian.net")
+
+# pylint: disable-next=wrong-import-position
+import jira_service_management_audit as audit  # noqa: E402
+
+
+def history(history_id):
+    """A changelog history with the given ID."""
+    return {
+        "id": str(history_id),
+        "author": {"emailAddress": "agent@example.com"},
+        "created": f"2024-06-01T00:00:{history_id:02d}.000+0000",
+    }
+
+
+def fetched(count, *history_ids):
+    """What fetch_histories returns for the given histories of an issue with
+    `count` histories."""
+    return [history(history_id) for history_id in history_ids], count
+
+
+class GetNewChangelogTest(unittest.TestCase):
+    """Fetching the histories added after a watermark."""
+
+    def setUp(self):
+        patcher = mock.patch.object(audit, "fetch_histories")
+        self.fetch_histories = patcher.start()
+        self.addCleanup(patcher.stop)
+        print_patcher = mock.patch("builtins.print")
+        print_patcher.start()
+        self.addCleanup(print_patcher.stop)
+
+    def test_without_a_watermark_everything_is_new(self):
+        """An issue seen for the first time is fetched in full."""
+        self.fetch_histories.return_value = fetched(3, 1, 2, 3)
+        rows, watermark = audit.get_new_changelog("SD-1", None)
+        self.fetch_histories.assert_called_once_with("SD-1")
+        self.assertEqual([row[3] for row in rows], ["1", "2", "3"])
+        self.assertEqual(watermark, {"count": 3, "last_id": "3"})
+
+    def test_fetches_from_the_last_exported_history(self):
+        """The page starts at the watermark's history, which is not repeated."""
+        self.fetch_histories.return_value = fetched(5, 3, 4, 5)
+        rows, watermark = audit.get_new_changelog(
+            "SD-1", {"count": 3, "last_id": "3"}
+        )
+        self.fetch_histories.assert_called_once_with("SD-1", 2)
+        self.assertEqual([row[3] for row in rows], ["4", "5"])
+        self.assertEqual(watermark, {"count": 5, "last_id": "5"})
+
+    def test_changed_changelog_is_filtered_by_id(self):
+        """If the watermark's history moved, the changelog is fetched in full
+        and only the histories after its ID are new."""
+        self.fetch_histories.side_effect = [fetched(4, 4, 5), fetched(4, 1, 3, 4, 5)]
+        rows, watermark = audit.get_new_changelog(
+            "SD-1", {"count": 3, "last_id": "3"}
+        )
+        self.assertEqual(
+            self.fetch_histories.call_args_list,
+            [mock.call("SD-1", 2), mock.call("SD-1")],
+        )
+        self.assertEqual([row[3] for row in rows], ["4", "5"])
+        self.assertEqual(watermark, {"count": 4, "last_id": "5"})
+
+    def test_no_histories_give_no_watermark(self):
+        """An issue without histories gets no watermark to store."""
+        self.fetch_histories.return_value = ([], 0)
+        rows, watermark = audit.get_new_changelog("SD-1", None)
+        self.assertEqual(rows, [])
+        self.assertIsNone(watermark)
+
+
+class JqlTest(unittest.TestCase):
+    """The JQL of incremental runs and time shards."""
+
+    def test_updated_since_adds_the_overlap(self):
+        """The search reaches back to the previous run plus the overlap."""
+        now = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+        last_run = (now - timedelta(minutes=90, seconds=1)).isoformat()
+        jql = audit.updated_since_jql("project = SD", last_run, now)
+        minutes = 91 + audit.INCREMENTAL_OVERLAP_MINUTES
+        self.assertEqual(jql, f"project = SD and updated >= -{minutes}m")
+
+    def test_time_shards_partition_the_window(self):
+        """Each slice starts where the previous one ends, and only the last
+        one is open-ended."""
+        anchor = datetime(2024, 6, 1, 0, 0)
+        width = timedelta(days=audit.UPDATED_WITHIN_DAYS) / 3
+        bounds = [
+            (anchor - width * (3 - index)).strftime(audit.JQL_DATE_FORMAT)
+            for index in range(3)
+        ]
+        self.assertEqual(
+            [audit.time_shard_jql(index, 3, anchor) for index in (1, 2, 3)],
+            [
+                f'{audit.JQL_FILTER} and updated >= "{bounds[0]}" '
+                f'and updated < "{bounds[1]}"',
+                f'{audit.JQL_FILTER} and updated >= "{bounds[1]}" '
+                f'and updated < "{bounds[2]}"',
+                f'{audit.JQL_FILTER} and updated >= "{bounds[2]}"',
+            ],
+        )
+
+
+class PruneStateTest(unittest.TestCase):
+    """Dropping the watermarks of issues that left the update window."""
+
+    def test_drops_issues_not_found_within_the_window(self):
+        """Only issues found within the window, or not yet stamped, stay."""
+        now = datetime(2024, 6, 1, tzinfo=timezone.utc)
+        recent = (now - timedelta(days=1)).isoformat()
+        old = (now - timedelta(days=audit.UPDATED_WITHIN_DAYS + 1)).isoformat()
+        state = {
+            "last_run": recent,
+            "issues": {
+                "SD-1": {"count": 1, "last_id": "1", "seen": recent},
+                "SD-2": {"count": 1, "last_id": "2", "seen": old},
+                "SD-3": {"count": 1, "last_id": "3"},
+            },
+        }
+        with mock.patch("builtins.print"):
+            audit.prune_state(state, now)
+        self.assertEqual(sorted(state["issues"]), ["SD-1", "SD-3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
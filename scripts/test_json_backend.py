@@ -0,0 +1,121 @@
+"""
+Tests for `json_backend.py`: the split of a page into its array items and
+envelope, and how a page that breaks off mid-body is reported. A local HTTP
+server stands in for the API.
+
+    python -m unittest test_json_backend
+"""
+
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import json_backend
+
+PAGE = (
+    b'{"data": [{"id": 1, "tags": ["a", "b"]}, {"id": 2, "tags": []}, 3],'
+    b' "links": {"next": "https://example.com/?cursor=abc"}, "total": 3}'
+)
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    """Serves PAGE whole at /page and cut off halfway at /truncated."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send the page, or half of it with the full Content-Length."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        if self.path.startswith("/truncated"):
+            self.wfile.write(PAGE[: len(PAGE) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            self.wfile.write(PAGE)
+
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        """Keep the test output quiet."""
+
+
+class IterArrayTest(unittest.TestCase):
+    """json_backend.iter_array against a local server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def get(self, path, stream):
+        """Request a path from the local server."""
+        return requests.get(f"{self.base_url}{path}", stream=stream, timeout=5)
+
+    def test_items_and_envelope_are_split(self):
+        """Items come from the array, the other members go to the envelope."""
+        for stream in (True, False):
+            with self.subTest(stream=stream):
+                envelope = {}
+                items = list(
+                    json_backend.iter_array(self.get("/page", stream), "data", envelope)
+                )
+                self.assertEqual(
+                    items, [{"id": 1, "tags": ["a", "b"]}, {"id": 2, "tags": []}, 3]
+                )
+                self.assertEqual(
+                    envelope,
+                    {"links": {"next": "https://example.com/?cursor=abc"}, "total": 3},
+                )
+
+    @unittest.skipIf(json_backend.ijson is None, "needs ijson to stream")
+    def test_truncated_stream_raises_a_request_exception(self):
+        """A body cut off mid-page surfaces as a retryable requests error."""
+        response = self.get("/truncated", stream=True)
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            list(json_backend.iter_array(response, "data"))
+
+    def test_invalid_json_raises_value_error(self):
+        """A page that is not JSON raises ValueError on either path."""
+        for stream in (True, False):
+            with self.subTest(stream=stream):
+                response = requests.Response()
+                response.status_code = 200
+                # pylint: disable-next=protected-access
+                response._content = b'{"data": [1, }'
+                if stream:
+                    if json_backend.ijson is None:
+                        continue
+                    response.raw = _BytesStream(b'{"data": [1, }')
+                else:
+                    response.raw = None
+                with self.assertRaises(ValueError):
+                    list(json_backend.iter_array(response, "data"))
+
+
+class _BytesStream:
+    """A minimal stand-in for `response.raw` over a byte string."""
+
+    def __init__(self, data):
+        self._data = data
+        self.decode_content = False
+
+    def read(self, size=-1):
+        """Read up to `size` bytes."""
+        if size < 0:
+            size = len(self._data)
+        chunk, self._data = self._data[:size], self._data[size:]
+        return chunk
+
+    def close(self):
+        """Nothing to release."""
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Tests for `request_budget.py`: rate parsing, priority ordering of waiters
+and the host-wide pause on 429 responses. No network access is needed.
+
+    python -m unittest test_request_budget
+"""
+
+import io
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from request_budget import RequestBudget, TokenBucket, parse_rates
+
+
+def fake_response(status_code, retry_after=None):
+    """A response with a status code and an optional Retry-After header."""
+    response = requests.Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(b"")
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return response
+
+
+class ParseRatesTest(unittest.TestCase):
+    """Parsing of REQUEST_BUDGET."""
+
+    def test_burst_defaults_to_the_rate(self):
+        """A host without a burst gets one equal to its rate."""
+        rates = parse_rates("example.atlassian.net=4")
+        self.assertEqual(rates["example.atlassian.net"], (4.0, 4.0))
+
+    def test_burst_is_at_least_one_request(self):
+        """A rate below one request per second still gets a whole token."""
+        rates = parse_rates("api.atlassian.com=0.5")
+        self.assertEqual(rates["api.atlassian.com"], (0.5, 1.0))
+
+    def test_rejects_a_burst_below_one_request(self):
+        """A burst below one could never hand out a token."""
+        with self.assertRaises(ValueError):
+            parse_rates("api.atlassian.com=0.5/0.5")
+
+    def test_rejects_a_rate_of_zero(self):
+        """A rate of zero would never refill the bucket."""
+        with self.assertRaises(ValueError):
+            parse_rates("*=0")
+
+    def test_slow_bucket_hands_out_its_token(self):
+        """A parsed sub-1/s budget does not block its first request."""
+        rate, burst = parse_rates("api.atlassian.com=0.5")["api.atlassian.com"]
+        acquired = threading.Event()
+        bucket = TokenBucket(rate, burst)
+        threading.Thread(
+            target=lambda: (bucket.acquire(), acquired.set()), daemon=True
+        ).start()
+        self.assertTrue(acquired.wait(1))
+
+
+class TokenBucketTest(unittest.TestCase):
+    """Waiters are served by priority, then first come, first served."""
+
+    def test_higher_priority_waiters_are_served_first(self):
+        """A later high-priority waiter overtakes the low-priority ones."""
+        bucket = TokenBucket(rate=100, burst=5)
+        bucket.pause(0.3)
+        order = []
+        lock = threading.Lock()
+
+        def wait_for_token(name, priority):
+            bucket.acquire(priority)
+            with lock:
+                order.append(name)
+
+        threads = []
+        for name, priority in [("low-1", 0), ("low-2", 0), ("high", 10)]:
+            thread = threading.Thread(target=wait_for_token, args=(name, priority))
+            thread.start()
+            threads.append(thread)
+            # Let each waiter queue up before the next one arrives
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join(2)
+
+        self.assertEqual(order, ["high", "low-1", "low-2"])
+
+
+class RequestBudgetTest(unittest.TestCase):
+    """The budget patched into requests.Session.request."""
+
+    def test_429_pauses_the_host_for_retry_after(self):
+        """A throttled request is sent again after the Retry-After delay."""
+        sent = []
+        responses = iter(
+            [fake_response(429, retry_after="0.3"), fake_response(200)]
+        )
+
+        def send(_session, method, url, *_args, **_kwargs):
+            sent.append((time.monotonic(), method, url))
+            return next(responses)
+
+        # Restored when the patch ends, undoing install() as well
+        with mock.patch.object(requests.Session, "request", send):
+            RequestBudget({"*": (100.0, 10.0)}).install()
+            with mock.patch("builtins.print"):
+                response = requests.Session().request(
+                    "GET", "https://example.atlassian.net/rest/api/3/myself"
+                )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(sent), 2)
+        self.assertGreaterEqual(sent[1][0] - sent[0][0], 0.3)
+
+    def test_pause_holds_every_request_to_the_host_only(self):
+        """A pause holds requests to its own host, not to other hosts."""
+        budget = RequestBudget({"*": (100.0, 10.0)})
+        paused = budget.bucket_for("https://example.atlassian.net/a")
+        other = budget.bucket_for("https://api.atlassian.com/a")
+        self.assertIs(paused, budget.bucket_for("https://example.atlassian.net/b"))
+
+        paused.pause(0.3)
+        started = time.monotonic()
+        other.acquire()
+        self.assertLess(time.monotonic() - started, 0.1)
+        paused.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.25)
+
+
+if __name__ == "__main__":
+    unittest.main()